@@ -1,21 +1,32 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
-from memory_manager import MemoryManager
-from llm_interface import LLMInterface
+from pydantic import BaseModel, Field
+from typing import Optional, List, Literal
+from memory_manager import MemoryManager, LEXICAL_WEIGHT, FUSION_METHOD
+from llm_interface import LLMInterface, LLMUnavailableError, LLMTimeoutError, is_deterministic
 import uvicorn
 import threading
-from auth_manager import verify_api_key
+from auth_manager import verify_api_key, verify_admin_key
+from profiler import profiler
+from retention import RetentionManager, RetentionPolicy, RETENTION_INTERVAL_SECONDS
 from auth_routes import router as auth_router
 import os
 from dotenv import load_dotenv
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, Response
+from utils import FastJSONResponse, json_array
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import hashlib
+import queue
 
 # Load environment variables
 load_dotenv()
 
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "2"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+
 
 # Initialize app
 app = FastAPI(
@@ -39,6 +50,7 @@ app.include_router(auth_router)
 # Thread-safe singleton pattern for memory and LLM
 _memory = None
 _llm = None
+_retention = None
 _lock = threading.Lock()
 
 def get_memory():
@@ -59,6 +71,22 @@ def get_llm():
                 _llm = LLMInterface(model_name="qwen2.5-coder:1.5b")
     return _llm
 
+def get_retention():
+    """Get or create retention manager (thread-safe)"""
+    global _retention
+    if _retention is None:
+        memory = get_memory()
+        with _lock:
+            if _retention is None:
+                _retention = RetentionManager(memory.db)
+    return _retention
+
+@app.on_event("startup")
+def start_retention_job():
+    """Start scheduled compaction when RETENTION_INTERVAL_SECONDS is set"""
+    if RETENTION_INTERVAL_SECONDS > 0:
+        get_retention().start(RETENTION_INTERVAL_SECONDS)
+
 # Request/Response Models
 class ThreadCreateRequest(BaseModel):
     thread_name: str
@@ -74,6 +102,12 @@ class ChatRequest(BaseModel):
     message: str
     max_tokens: Optional[int] = 2000
     top_k: Optional[int] = 100
+    temperature: Optional[float] = None
+    seed: Optional[int] = None
+    idempotency_key: Optional[str] = None
+    diversify: bool = False
+    mmr_lambda: float = Field(0.7, ge=0, le=1)
+    dedup_threshold: float = Field(0.95, ge=0, le=1)
 
 class ChatResponse(BaseModel):
     thread_id: int
@@ -82,6 +116,45 @@ class ChatResponse(BaseModel):
     retrieved_messages: int
     token_count: int
 
+class RetentionPolicyRequest(RetentionPolicy):
+    scope: str  # "thread" or "user"
+    scope_id: str
+
+class RetrieveRequest(BaseModel):
+    thread_id: int
+    message: str
+    max_tokens: Optional[int] = 2000
+    top_k: Optional[int] = 100
+    semantic_weight: float = 0.7
+    recency_weight: float = 0.3
+    lexical_weight: float = LEXICAL_WEIGHT
+    fusion: Literal["weighted", "rrf"] = FUSION_METHOD
+    diversify: bool = False
+    mmr_lambda: float = Field(0.7, ge=0, le=1)
+    dedup_threshold: float = Field(0.95, ge=0, le=1)
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+    max_concurrency: Optional[int] = None
+
+class BatchRetrieveRequest(BaseModel):
+    items: List[RetrieveRequest]
+
+class ProfilingConfigRequest(BaseModel):
+    sample_rate: Optional[float] = None
+    mode: Optional[str] = None  # "stack" or "cprofile"
+    reset: bool = False
+
+class ThreadSuggestRequest(BaseModel):
+    message: str
+    top_n: int = 5
+
+class CrossThreadSearchRequest(BaseModel):
+    message: str
+    top_threads: int = 5
+    top_k: int = 10
+    max_tokens: int = 4000
+
 class ThreadListResponse(BaseModel):
     threads: List[dict]
     total: int
@@ -94,6 +167,16 @@ class AnalyticsResponse(BaseModel):
     total_tokens_used: int
     threads_accessed: int
     retrieval_methods: dict
+    llm_context: dict = {}
+
+def build_llm_options(request):
+    """Ollama sampling options set on the request, if any"""
+    options = {}
+    if request.temperature is not None:
+        options["temperature"] = request.temperature
+    if request.seed is not None:
+        options["seed"] = request.seed
+    return options or None
 
 # API Endpoints
 # Serve static files (add this before other routes)
@@ -119,7 +202,7 @@ def create_thread(request: ThreadCreateRequest, key_data: dict = Depends(verify_
     """Create a new conversation thread"""
     try:
         memory = get_memory()
-        thread_id = memory.create_thread(request.thread_name)
+        thread_id = memory.create_thread(request.thread_name, user_id=request.user_id or key_data.get("user_id"))
         return ThreadCreateResponse(
             thread_id=thread_id,
             thread_name=request.thread_name,
@@ -129,6 +212,7 @@ def create_thread(request: ThreadCreateRequest, key_data: dict = Depends(verify_
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/threads/list", response_model=ThreadListResponse)
+@profiler.profile("/threads/list")
 def list_threads(key_data: dict = Depends(verify_api_key)):
     """List all conversation threads"""
     try:
@@ -149,27 +233,55 @@ def list_threads(key_data: dict = Depends(verify_api_key)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/chat", response_model=ChatResponse)
-def chat(request: ChatRequest, key_data: dict = Depends(verify_api_key)):
-    """Send a message and get AI response with memory"""
+def run_chat(request: ChatRequest, user_id=None, query_emb=None, candidates=None):
+    """
+    Store the user message, retrieve history, generate and store the reply.
+    Batch callers pass a precomputed query_emb and the thread's loaded
+    candidates, which are extended with this turn's messages.
+    If the turn fails, the stored user message is removed again.
+    """
+    memory = get_memory()
+    llm = get_llm()
+    # Don't store a user turn that can't get a reply
+    llm.check_available()
+    
+    # Identify the turn for the response cache before it is stored, so retries and duplicates share a key
+    cache_scope = None
+    if llm.response_cache is not None and is_deterministic(build_llm_options(request)):
+        cache_scope = memory.turn_cache_scope(request.thread_id, request.message, [
+            request.top_k, request.max_tokens, request.diversify, request.mmr_lambda, request.dedup_threshold
+        ])
+    
+    # Add user message
+    user_msg_id = memory.add_message(request.thread_id, "user", request.message, user_id=user_id, embedding=query_emb)
     try:
-        memory = get_memory()
-        llm = get_llm()
-        
-        # Add user message
-        memory.add_message(request.thread_id, "user", request.message)
-        
-        # Retrieve MORE relevant history
-        relevant_history = memory.get_hybrid_matches_with_token_limit(
-            request.thread_id,
-            request.message,
-            top_k=20,  # ✅ Retrieve up to 20 messages
-            max_tokens=request.max_tokens or 3000
-        )
-        
-        # Build better prompt with clear structure
-        # Add at the start of the prompt
-        prompt = """You are RecallGPT, an AI assistant with perfect memory. 
+        return complete_chat(request, memory, llm, user_msg_id, user_id, query_emb, candidates, cache_scope)
+    except Exception:
+        # Don't leave a user turn without a reply behind; a retry would store it again
+        try:
+            memory.db.delete_message(request.thread_id, user_msg_id)
+        except Exception as e:
+            print(f"Failed to remove orphaned message {user_msg_id}: {e}")
+        raise
+
+def complete_chat(request: ChatRequest, memory, llm, user_msg_id, user_id, query_emb, candidates, cache_scope=None):
+    """Retrieve history, generate and store the reply for an already stored user turn"""
+    # Retrieve MORE relevant history
+    relevant_history = memory.get_hybrid_matches_with_token_limit(
+        request.thread_id,
+        request.message,
+        top_k=request.top_k,
+        max_tokens=request.max_tokens or 3000,
+        diversify=request.diversify,
+        mmr_lambda=request.mmr_lambda,
+        dedup_threshold=request.dedup_threshold,
+        query_emb=query_emb,
+        candidates=candidates
+    )
+    
+    # Build better prompt with clear structure
+    # Add at the start of the prompt
+    prompt = """You are RecallGPT, an AI assistant with perfect memory. 
 
         IMPORTANT RULES:
         1. Always use conversation history to provide personalized responses
@@ -180,67 +292,284 @@ def chat(request: ChatRequest, key_data: dict = Depends(verify_api_key)):
         === Conversation History ===
         """
 
-        prompt += "\n\nWhen answering, EXPLICITLY reference relevant context from conversation history."
-        
-        if relevant_history:
-            prompt += "=== Conversation History ===\n"
-            for role, content in relevant_history:
-                prompt += f"{role.capitalize()}: {content}\n\n"
-        
-        prompt += "=== Current Question ===\n"
-        prompt += f"User: {request.message}\n\n"
-        prompt += "Assistant:"
-        
-        # Generate response
-        response = llm.generate(prompt)
-        memory.add_message(request.thread_id, "assistant", response)
-        
-        # Log retrieval
-        token_count = memory.count_tokens(prompt)
-        memory.logger.log_retrieval(
-            thread_id=request.thread_id,
-            query=request.message,
-            retrieved_count=len(relevant_history),
-            token_count=token_count,
-            response_length=len(response),
-            retrieval_method="hybrid_token_limited",
-            context_msgs=relevant_history
-        )
-        
-        return ChatResponse(
-            thread_id=request.thread_id,
-            user_message=request.message,
-            assistant_response=response,
-            retrieved_messages=len(relevant_history),
-            token_count=token_count
+    prompt += "\n\nWhen answering, EXPLICITLY reference relevant context from conversation history."
+    
+    if relevant_history:
+        prompt += "=== Conversation History ===\n"
+        for role, content in relevant_history:
+            prompt += f"{role.capitalize()}: {content}\n\n"
+    
+    followup_prompt = "=== Current Question ===\n"
+    followup_prompt += f"User: {request.message}\n\n"
+    followup_prompt += "Assistant:"
+    prompt += followup_prompt
+    
+    # Generate response (reuses the thread's Ollama context when history is unchanged)
+    response = llm.generate(
+        prompt,
+        thread_id=request.thread_id,
+        history=relevant_history,
+        message=request.message,
+        followup_prompt=followup_prompt,
+        options=build_llm_options(request),
+        cache_scope=cache_scope
+    )
+    response_emb = memory.model.encode(response) if candidates is not None else None
+    reply_msg_id = memory.add_message(request.thread_id, "assistant", response, user_id=user_id, embedding=response_emb)
+    if candidates is not None:
+        memory.append_candidate(candidates, user_msg_id, "user", request.message, query_emb)
+        memory.append_candidate(candidates, reply_msg_id, "assistant", response, response_emb)
+    
+    # Log retrieval
+    token_count = memory.count_tokens(prompt)
+    memory.logger.log_retrieval(
+        thread_id=request.thread_id,
+        query=request.message,
+        retrieved_count=len(relevant_history),
+        token_count=token_count,
+        response_length=len(response),
+        retrieval_method="hybrid_token_limited",
+        context_msgs=relevant_history
+    )
+    
+    return ChatResponse(
+        thread_id=request.thread_id,
+        user_message=request.message,
+        assistant_response=response,
+        retrieved_messages=len(relevant_history),
+        token_count=token_count
+    )
+
+
+def llm_unavailable(e):
+    """503 (504 on timeout) with a Retry-After hint so clients back off"""
+    headers = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after else None
+    status_code = 504 if isinstance(e, LLMTimeoutError) else 503
+    return HTTPException(status_code=status_code, detail=str(e), headers=headers)
+
+def run_chat_once(request: ChatRequest, user_id=None, query_emb=None, candidates=None):
+    """
+    run_chat honoring request.idempotency_key: a retry with a used key replays
+    the stored result instead of writing the messages again. Raises a 409
+    HTTPException while the key's first request is still in progress, and a
+    422 when the key is reused with a different request body.
+    """
+    if not request.idempotency_key:
+        return run_chat(request, user_id, query_emb=query_emb, candidates=candidates)
+    
+    memory = get_memory()
+    idem_key = f"{user_id}:{request.idempotency_key}"
+    request_hash = hashlib.sha256(request.model_dump_json().encode("utf-8")).hexdigest()
+    try:
+        claimed, stored = memory.db.claim_idempotency_key(idem_key, request_hash)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if stored is not None:
+        return ChatResponse.model_validate_json(stored)
+    if not claimed:
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this idempotency key is still in progress"
         )
+    try:
+        result = run_chat(request, user_id, query_emb=query_emb, candidates=candidates)
+    except Exception:
+        memory.db.release_idempotency_key(idem_key)
+        raise
+    memory.db.complete_idempotency_key(idem_key, result.model_dump_json())
+    return result
+
+@app.post("/chat", response_model=ChatResponse)
+@profiler.profile("/chat")
+def chat(request: ChatRequest, key_data: dict = Depends(verify_api_key)):
+    """Send a message and get AI response with memory"""
+    try:
+        return run_chat_once(request, key_data.get("user_id"))
+    except HTTPException:
+        raise
+    except LLMUnavailableError as e:
+        raise llm_unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def run_retrieve(request: RetrieveRequest, query_emb=None, candidates=None):
+    """Retrieval only (the query is not stored): selected messages with scores and stage timings"""
+    memory = get_memory()
+    result = memory.retrieve_with_scores(
+        request.thread_id,
+        request.message,
+        top_k=request.top_k,
+        max_tokens=request.max_tokens or 3000,
+        semantic_weight=request.semantic_weight,
+        recency_weight=request.recency_weight,
+        lexical_weight=request.lexical_weight,
+        fusion=request.fusion,
+        diversify=request.diversify,
+        mmr_lambda=request.mmr_lambda,
+        dedup_threshold=request.dedup_threshold,
+        exclude_latest=False,
+        query_emb=query_emb,
+        candidates=candidates
+    )
+    return {"thread_id": request.thread_id, "count": len(result["messages"]), **result}
+
+@app.post("/retrieve")
+@profiler.profile("/retrieve")
+def retrieve(request: RetrieveRequest, key_data: dict = Depends(verify_api_key)):
+    """Run retrieval without the LLM and explain the scores; for tuning weights, top_k and max_tokens"""
+    try:
+        return run_retrieve(request)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def group_by_thread(items):
+    """thread_id -> [(index, item)] keeping request order within each thread"""
+    groups = {}
+    for index, item in enumerate(items):
+        groups.setdefault(item.thread_id, []).append((index, item))
+    return groups
+
+def check_batch_size(items):
+    if not items:
+        raise HTTPException(status_code=400, detail="Batch has no items")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+
+@app.post("/chat/batch")
+def chat_batch(request: BatchChatRequest, key_data: dict = Depends(verify_api_key)):
+    """
+    Run many chat turns in one call, streamed back as NDJSON.
+    Queries are encoded in one model call; each thread is loaded once and its
+    turns run in order, while threads run in parallel up to max_concurrency.
+    Item idempotency keys behave as on /chat (a used key replays its result).
+    The handler returns at once, so profiling samples each thread's run instead.
+    """
+    check_batch_size(request.items)
+    memory = get_memory()
+    user_id = key_data.get("user_id")
+    query_embs = memory.model.encode([item.message for item in request.items])
+    concurrency = max(1, min(request.max_concurrency or BATCH_LLM_CONCURRENCY, BATCH_LLM_CONCURRENCY))
+    results = queue.Queue()
+    
+    @profiler.profile("/chat/batch")
+    def run_thread(thread_id, turns):
+        try:
+            # Huge threads go through the per-query lexical pre-filter instead of a full load
+            candidates = None if memory.uses_prefilter(thread_id) else memory.load_candidates(thread_id, exclude_latest=False)
+        except Exception as e:
+            for index, item in turns:
+                results.put({"index": index, "thread_id": thread_id, "error": str(e)})
+            return
+        for index, item in turns:
+            try:
+                result = run_chat_once(item, user_id, query_emb=query_embs[index], candidates=candidates)
+                results.put({"index": index, **result.model_dump()})
+            except HTTPException as e:
+                results.put({"index": index, "thread_id": thread_id, "error": e.detail})
+            except Exception as e:
+                results.put({"index": index, "thread_id": thread_id, "error": str(e)})
+    
+    groups = group_by_thread(request.items)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    for thread_id, turns in groups.items():
+        future = executor.submit(run_thread, thread_id, turns)
+        # The sentinel is queued after every line the thread produced
+        future.add_done_callback(lambda f, thread_id=thread_id: results.put({"_done": thread_id, "_error": f.exception()}))
+    executor.shutdown(wait=False)
+    
+    def stream():
+        # Count down on finished threads, so a thread that dies early can't leave the stream waiting
+        emitted = set()
+        pending = len(groups)
+        while pending:
+            line = results.get()
+            if "_done" not in line:
+                emitted.add(line["index"])
+                yield json.dumps(line) + "\n"
+                continue
+            pending -= 1
+            for index, item in groups[line["_done"]]:
+                if index not in emitted:
+                    error = str(line["_error"] or "Batch item was not processed")
+                    yield json.dumps({"index": index, "thread_id": item.thread_id, "error": error}) + "\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@profiler.profile("/retrieve/batch")
+def retrieve_thread_lines(thread_id, items, query_embs):
+    """NDJSON lines for one thread's retrieval items; the thread is loaded once"""
+    memory = get_memory()
+    try:
+        candidates = None if memory.uses_prefilter(thread_id) else memory.load_candidates(thread_id, exclude_latest=False)
+    except Exception as e:
+        return [json.dumps({"index": index, "thread_id": thread_id, "error": str(e)}) + "\n" for index, item in items]
+    lines = []
+    for index, item in items:
+        try:
+            line = {"index": index, **run_retrieve(item, query_emb=query_embs[index], candidates=candidates)}
+        except Exception as e:
+            line = {"index": index, "thread_id": thread_id, "error": str(e)}
+        lines.append(json.dumps(line) + "\n")
+    return lines
+
+@app.post("/retrieve/batch")
+def retrieve_batch(request: BatchRetrieveRequest, key_data: dict = Depends(verify_api_key)):
+    """
+    Retrieve context for many (thread_id, message) pairs without calling the LLM, streamed as NDJSON.
+    The work runs while the body streams, so profiling samples each thread's lines instead of the handler.
+    """
+    check_batch_size(request.items)
+    memory = get_memory()
+    query_embs = memory.model.encode([item.message for item in request.items])
+    
+    def stream():
+        for thread_id, items in group_by_thread(request.items).items():
+            yield from retrieve_thread_lines(thread_id, items, query_embs)
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 @app.get("/threads/{thread_id}/history")
-def get_thread_history(thread_id: int, limit: int = 10, key_data: dict = Depends(verify_api_key)):
+@profiler.profile("/threads/{thread_id}/history")
+def get_thread_history(thread_id: int, limit: int = 10, include_archived: bool = False,
+                       key_data: dict = Depends(verify_api_key)):
     """Get conversation history for a thread"""
     try:
         memory = get_memory()
-        history = memory.get_recent_history(thread_id, n=limit)
-        return {
+        rows = None if include_archived else memory.db.get_thread_history_json(thread_id, limit)
+        if rows is not None:
+            # Rows come pre-encoded from SQLite; splice them into the body as-is
+            body = f'{{"thread_id":{thread_id},"messages":{json_array(rows)},"count":{len(rows)}}}'
+            return Response(content=body, media_type="application/json")
+        history = memory.get_recent_history(thread_id, n=limit, include_archived=include_archived)
+        return FastJSONResponse({
             "thread_id": thread_id,
-            "messages": [
-                {"role": role, "content": content}
-                for role, content in history
-            ],
+            "messages": [record._asdict() for record in history],
             "count": len(history)
-        }
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/threads/{thread_id}/export")
+def export_thread(thread_id: int, key_data: dict = Depends(verify_api_key)):
+    """Stream every message of a thread as NDJSON, encoded row by row by SQLite"""
+    memory = get_memory()
+    
+    def stream():
+        for row in memory.db.iter_thread_export(thread_id):
+            yield row + "\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 @app.get("/analytics", response_model=AnalyticsResponse)
+@profiler.profile("/analytics")
 def get_analytics(key_data: dict = Depends(verify_api_key)):
     """Get system analytics and usage statistics"""
     try:
         memory = get_memory()
-        stats, logs = memory.logger.get_stats()
+        llm_stats = get_llm().get_stats()
+        stats, _ = memory.logger.get_stats(include_logs=False)
         
         if not stats:
             return AnalyticsResponse(
@@ -250,20 +579,162 @@ def get_analytics(key_data: dict = Depends(verify_api_key)):
                 avg_response_length=0.0,
                 total_tokens_used=0,
                 threads_accessed=0,
-                retrieval_methods={}
+                retrieval_methods={},
+                llm_context=llm_stats
             )
-        return AnalyticsResponse(**stats)
+        return AnalyticsResponse(**stats, llm_context=llm_stats)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/threads/suggest")
+@profiler.profile("/threads/suggest")
+def suggest_threads(request: ThreadSuggestRequest, key_data: dict = Depends(verify_api_key)):
+    """Suggest existing threads related to a message, ranked by centroid similarity"""
+    try:
+        memory = get_memory()
+        suggestions = memory.suggest_threads(request.message, top_n=request.top_n, user_id=key_data.get("user_id"))
+        return {
+            "threads": [
+                {"thread_id": tid, "thread_name": name, "score": score}
+                for tid, name, score in suggestions
+            ],
+            "total": len(suggestions)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/search")
+@profiler.profile("/search")
+def search_across_threads(request: CrossThreadSearchRequest, key_data: dict = Depends(verify_api_key)):
+    """Semantic search over the caller's threads; centroids prune threads before message scoring"""
+    try:
+        memory = get_memory()
+        results = memory.search_across_threads(
+            request.message,
+            user_id=key_data.get("user_id"),
+            top_threads=request.top_threads,
+            top_k=request.top_k,
+            max_tokens=request.max_tokens
+        )
+        return {"query": request.message, "results": results, "count": len(results)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/admin/centroids/rebuild")
+def rebuild_centroids(key_data: dict = Depends(verify_admin_key)):
+    """Recompute thread centroids from stored embeddings"""
+    try:
+        return {"rebuilt_threads": get_memory().rebuild_centroids()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/messages/search")
+@profiler.profile("/messages/search")
+def search_messages(q: str, limit: int = 50, key_data: dict = Depends(verify_api_key)):
+    """Search the caller's message text across all threads (fans out over every shard)"""
+    try:
+        memory = get_memory()
+        results = memory.search_messages(q, user_id=key_data.get("user_id"), limit=limit)
+        return {
+            "query": q,
+            "results": [
+                {"thread_id": tid, "role": role, "content": content, "timestamp": ts}
+                for tid, role, content, ts in results
+            ],
+            "count": len(results)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/analytics/storage")
+def get_storage_analytics(key_data: dict = Depends(verify_api_key)):
+    """Per-shard message counts and file sizes"""
+    try:
+        memory = get_memory()
+        shards = memory.db.shard_stats()
+        return {
+            "num_shards": memory.db.num_shards,
+            "shards": shards,
+            "total_messages": sum(s["messages"] for s in shards)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/retention/policies")
+def set_retention_policy(request: RetentionPolicyRequest, key_data: dict = Depends(verify_admin_key)):
+    """Set a per-thread or per-user retention policy"""
+    try:
+        policy = RetentionPolicy(**request.model_dump(exclude={"scope", "scope_id"}))
+        get_retention().set_policy(request.scope, request.scope_id, policy)
+        return {"message": "Retention policy saved", "scope": request.scope, "scope_id": request.scope_id}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/retention/run")
+def run_retention(key_data: dict = Depends(verify_admin_key)):
+    """Apply retention policies and compact now; reports reclaimed space"""
+    try:
+        return get_retention().run_once()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/retention/status")
+def retention_status(key_data: dict = Depends(verify_admin_key)):
+    """Last compaction report"""
+    retention = get_retention()
+    return {
+        "default_policy": retention.default_policy.model_dump(),
+        "last_report": retention.last_report
+    }
+
+
+@app.get("/admin/profiling")
+def profiling_status(key_data: dict = Depends(verify_admin_key)):
+    """Current sampling configuration and sampled request counts"""
+    return profiler.status()
+
+@app.post("/admin/profiling")
+def configure_profiling(request: ProfilingConfigRequest, key_data: dict = Depends(verify_admin_key)):
+    """Change the sampled fraction of requests (0 turns profiling off) or the mode"""
+    try:
+        profiler.configure(sample_rate=request.sample_rate, mode=request.mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if request.reset:
+        profiler.reset()
+    return profiler.status()
+
+@app.get("/admin/profiling/report", response_class=PlainTextResponse)
+def profiling_report(endpoint: str, save: bool = False, key_data: dict = Depends(verify_admin_key)):
+    """Collapsed stacks (stack mode, flamegraph input) or cProfile stats for an endpoint"""
+    if profiler.mode == "cprofile":
+        return profiler.cprofile_report(endpoint)
+    if save:
+        return f"saved to {profiler.dump(endpoint)}\n"
+    return profiler.collapsed(endpoint)
+
+@app.post("/admin/profiling/heap-snapshot")
+def heap_snapshot(limit: int = 20, stop: bool = False, key_data: dict = Depends(verify_admin_key)):
+    """First call starts tracemalloc; later calls write a snapshot and return top allocation sites"""
+    try:
+        return profiler.heap_snapshot(limit=limit, stop=stop)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/health")
 def health_check():
-    """Health check endpoint"""
+    """Health check endpoint; LLM state is passive (from recent calls), the backend is not pinged"""
+    llm_health = get_llm().get_health()
     return {
-        "status": "healthy",
+        "status": "healthy" if llm_health["status"] == "ok" else "degraded",
         "database": "connected",
-        "model": "loaded"
+        "model": "loaded",
+        "llm": llm_health
     }
 
 # Run server
@@ -10,6 +10,7 @@ import json
 # Load from .env
 API_KEY_ENABLED = os.getenv("API_KEY_ENABLED", "True").lower() == "true"
 API_KEYS_FILE = "api_keys.json"
+ADMIN_USER_IDS = {u.strip() for u in os.getenv("ADMIN_USER_IDS", "").split(",") if u.strip()}
 
 class APIKeyData(BaseModel):
     """API Key model"""
@@ -132,3 +133,12 @@ async def verify_api_key(api_key: str = Depends(api_key_header)) -> dict:
         )
     
     return key_data
+
+async def verify_admin_key(key_data: dict = Depends(verify_api_key)) -> dict:
+    """Verify API key belongs to an admin (ADMIN_USER_IDS)"""
+    if API_KEY_ENABLED and key_data.get("user_id") not in ADMIN_USER_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin API key required"
+        )
+    return key_data
@@ -0,0 +1,77 @@
+import threading
+import time
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend the breaker considers unhealthy"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+    closed -> open after failure_threshold consecutive failures.
+    open -> half_open once reset_seconds have passed; one probe call is let
+    through, and its outcome closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def check(self):
+        """Raise CircuitOpenError while open, without claiming the half-open probe"""
+        with self.lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.reset_seconds - time.monotonic()
+                if remaining > 0:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(remaining)
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        with self.lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.reset_seconds - time.monotonic()
+                if remaining > 0:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(remaining)
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probe_in_flight:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(self.reset_seconds)
+                self.probe_in_flight = True
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats["opened"] += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def get_state(self):
+        with self.lock:
+            state = {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                **self.stats
+            }
+            if self.state == "open":
+                state["retry_after_seconds"] = max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+            return state
@@ -1,16 +1,206 @@
 import sqlite3
 import datetime
 import threading
+import queue
+import os
+import pickle
+import zlib
+import json
+import re
+import time
+import numpy as np
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+
+DB_GROUP_COMMIT = os.getenv("DB_GROUP_COMMIT", "True").lower() == "true"
+DB_GROUP_COMMIT_MAX_BATCH = int(os.getenv("DB_GROUP_COMMIT_MAX_BATCH", "64"))
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT", "600"))
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+DB_SHARD_DIR = os.getenv("DB_SHARD_DIR", "")
+CENTROID_FLUSH_SECONDS = float(os.getenv("CENTROID_FLUSH_SECONDS", "5"))
+
+MESSAGES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS messages (
+        msg_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        thread_id INTEGER,
+        role TEXT,
+        content TEXT,
+        embedding BLOB,
+        user_id TEXT,
+        timestamp TEXT,
+        FOREIGN KEY(thread_id) REFERENCES threads(thread_id)
+    )
+'''
+
+# Per-thread lookups (history, counts, candidate loads) would otherwise scan the whole shard
+MESSAGES_INDEX = "CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(thread_id, timestamp)"
+
+ARCHIVE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS archived_messages (
+        archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        thread_id INTEGER,
+        reason TEXT,
+        msg_count INTEGER,
+        payload BLOB,
+        archived_at TEXT
+    )
+'''
+
+# thread_id is indexed as a token so a query can intersect with the thread's
+# doclist inside FTS5 instead of matching the whole shard and filtering after
+FTS_SCHEMA = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+       USING fts5(content, thread_id, content='messages', content_rowid='msg_id')''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+           INSERT INTO messages_fts(rowid, content, thread_id) VALUES (new.msg_id, new.content, new.thread_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+           INSERT INTO messages_fts(messages_fts, rowid, content, thread_id) VALUES ('delete', old.msg_id, old.content, old.thread_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content, thread_id ON messages BEGIN
+           INSERT INTO messages_fts(messages_fts, rowid, content, thread_id) VALUES ('delete', old.msg_id, old.content, old.thread_id);
+           INSERT INTO messages_fts(rowid, content, thread_id) VALUES (new.msg_id, new.content, new.thread_id);
+       END''',
+]
+FTS_TRIGGERS = ["messages_fts_ai", "messages_fts_ad", "messages_fts_au"]
+
+class MessageRecord(NamedTuple):
+    """Compact (role, content) message row; unpacks and compares like the plain tuple"""
+    role: str
+    content: str
+
+def message_record_factory(cursor, row):
+    return MessageRecord(*row)
+
+def fts_query(text):
+    """Turn free text into an FTS5 OR-query of quoted terms (no operator injection)"""
+    terms = re.findall(r"\w+", text.lower())
+    return " OR ".join(f'"{term}"' for term in dict.fromkeys(terms))
+
+def setup_fts(conn):
+    """Create the FTS5 index and sync triggers; returns False if FTS5 is unavailable"""
+    try:
+        row = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name='messages_fts'"
+        ).fetchone()
+        exists = row is not None
+        if exists and "thread_id" not in row[0]:
+            # Index from before thread_id was a column; recreate and rebuild it
+            for trigger in FTS_TRIGGERS:
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.execute("DROP TABLE messages_fts")
+            exists = False
+        for statement in FTS_SCHEMA:
+            conn.execute(statement)
+        if not exists:
+            # Index messages written before the index existed
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        conn.commit()
+        return True
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 unavailable, lexical retrieval disabled: {e}")
+        return False
+
+def shard_files_for(db_file, num_shards, shard_dir=DB_SHARD_DIR):
+    """
+    Message files for a layout. A single shard keeps messages in db_file
+    itself; otherwise shard i lives in <shard_dir>/<name>.shard<i>.db
+    """
+    if num_shards <= 1:
+        return [db_file]
+    base, ext = os.path.splitext(os.path.basename(db_file))
+    directory = shard_dir or os.path.dirname(db_file)
+    return [os.path.join(directory, f"{base}.shard{i}{ext or '.db'}") for i in range(num_shards)]
+
+class GroupCommitWriter:
+    """
+    Single background writer that batches inserts from concurrent requests.
+    Whatever is queued while a transaction commits goes into the next one, so
+    under load many rows share one commit (and one fsync). submit() blocks
+    until its row is committed, which keeps read-your-writes for the caller.
+    """
+
+    def __init__(self, db_file, max_batch=DB_GROUP_COMMIT_MAX_BATCH):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.stats = {"rows": 0, "transactions": 0}
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, sql, params):
+        """Queue one write and wait for it to be committed; returns lastrowid"""
+        item = {"sql": sql, "params": params, "event": threading.Event(), "rowid": None, "error": None}
+        self.queue.put(item)
+        item["event"].wait()
+        if item["error"] is not None:
+            raise item["error"]
+        return item["rowid"]
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                cur = conn.cursor()
+                for item in batch:
+                    cur.execute(item["sql"], item["params"])
+                    item["rowid"] = cur.lastrowid
+                conn.commit()
+                self.stats["transactions"] += 1
+            except Exception:
+                conn.rollback()
+                # Fall back to one transaction per row so a bad row only fails its own request
+                for item in batch:
+                    try:
+                        cur = conn.cursor()
+                        cur.execute(item["sql"], item["params"])
+                        item["rowid"] = cur.lastrowid
+                        conn.commit()
+                        self.stats["transactions"] += 1
+                    except Exception as e:
+                        conn.rollback()
+                        item["error"] = e
+            self.stats["rows"] += len(batch)
+            for item in batch:
+                item["event"].set()
 
 class DBManager:
-    def __init__(self, db_file='recallgpt.db'):
+    """
+    The catalog file (db_file) holds threads, the thread -> shard map and
+    idempotency keys. Messages live in one of num_shards SQLite files, picked
+    per thread, so each shard has its own write lock.
+    """
+    
+    def __init__(self, db_file='recallgpt.db', group_commit=DB_GROUP_COMMIT, num_shards=DB_SHARDS):
         self.db_file = db_file  # Store filename, NOT connection
+        self.num_shards = max(1, num_shards)
+        self.shard_files = shard_files_for(db_file, self.num_shards)
+        for path in self.shard_files:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
         self.local = threading.local()
+        self.shard_cache = {}  # thread_id -> shard index
+        self.centroid_deltas = {}  # thread_id -> [embedding sum, count] not yet written to the catalog
+        self.centroid_lock = threading.Lock()
+        self.centroid_flush_lock = threading.Lock()
+        self.fts_enabled = True
+        self.json_enabled = True
         self.setup_db()
+        self.writers = [GroupCommitWriter(f) for f in self.shard_files] if group_commit else None
+        self.executor = ThreadPoolExecutor(max_workers=self.num_shards) if self.num_shards > 1 else None
+        self.centroid_flusher = threading.Thread(target=self._flush_centroids_loop, daemon=True)
+        self.centroid_flusher.start()
     
     @property
     def conn(self):
-        """Get thread-local database connection"""
+        """Get thread-local catalog connection"""
         if not hasattr(self.local, 'connection') or self.local.connection is None:
             self.local.connection = sqlite3.connect(
                 self.db_file,
@@ -18,58 +208,177 @@ class DBManager:
             )
         return self.local.connection
     
+    def shard_conn(self, shard):
+        """Get thread-local connection to a message shard"""
+        if self.shard_files[shard] == self.db_file:
+            return self.conn
+        if not hasattr(self.local, 'shard_connections'):
+            self.local.shard_connections = {}
+        if shard not in self.local.shard_connections:
+            self.local.shard_connections[shard] = sqlite3.connect(
+                self.shard_files[shard],
+                check_same_thread=False
+            )
+        return self.local.shard_connections[shard]
+    
+    def conn_for_thread(self, thread_id):
+        """Connection to the shard holding a thread's messages"""
+        return self.shard_conn(self.shard_for_thread(thread_id))
+    
+    def shard_for_thread(self, thread_id, assign=False):
+        """
+        Look up the shard for a thread; unmapped threads hash to one.
+        The mapping is only persisted with assign (thread creation and writes)
+        and only for threads that exist, so reads never write to the catalog.
+        """
+        if self.num_shards == 1:
+            return 0
+        shard = self.shard_cache.get(thread_id)
+        if shard is not None:
+            return shard
+        cur = self.conn.cursor()
+        cur.execute("SELECT shard FROM thread_shards WHERE thread_id=?", (thread_id,))
+        row = cur.fetchone()
+        if row is not None and row[0] < self.num_shards:
+            self.shard_cache[thread_id] = row[0]
+            return row[0]
+        shard = thread_id % self.num_shards
+        if assign:
+            cur.execute("SELECT 1 FROM threads WHERE thread_id=?", (thread_id,))
+            if cur.fetchone() is not None:
+                cur.execute(
+                    "INSERT OR REPLACE INTO thread_shards (thread_id, shard) VALUES (?, ?)",
+                    (thread_id, shard)
+                )
+                self.conn.commit()
+                self.shard_cache[thread_id] = shard
+        return shard
+    
     def setup_db(self):
-        """Initialize database schema"""
+        """Initialize catalog and shard schemas"""
         cur = self.conn.cursor()
         
         cur.execute('''
             CREATE TABLE IF NOT EXISTS threads (
                 thread_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 thread_name TEXT,
-                created_at TEXT
+                created_at TEXT,
+                user_id TEXT,
+                centroid BLOB,
+                centroid_count INTEGER DEFAULT 0
             )
         ''')
         
+        # Older databases predate the owner/centroid columns
+        columns = {row[1] for row in cur.execute("PRAGMA table_info(threads)")}
+        for column, ddl in [
+            ("user_id", "user_id TEXT"),
+            ("centroid", "centroid BLOB"),
+            ("centroid_count", "centroid_count INTEGER DEFAULT 0"),
+        ]:
+            if column not in columns:
+                cur.execute(f"ALTER TABLE threads ADD COLUMN {ddl}")
+        
         cur.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                msg_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                thread_id INTEGER,
-                role TEXT,
-                content TEXT,
-                embedding BLOB,
-                user_id TEXT,
-                timestamp TEXT,
-                FOREIGN KEY(thread_id) REFERENCES threads(thread_id)
+            CREATE TABLE IF NOT EXISTS thread_shards (
+                thread_id INTEGER PRIMARY KEY,
+                shard INTEGER
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS retention_policies (
+                scope TEXT,
+                scope_id TEXT,
+                embedding_max_age_days INTEGER,
+                archive_after_days INTEGER,
+                max_messages INTEGER,
+                PRIMARY KEY (scope, scope_id)
             )
         ''')
         
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                idem_key TEXT PRIMARY KEY,
+                status TEXT,
+                response TEXT,
+                created_at TEXT,
+                request_hash TEXT
+            )
+        ''')
+        if "request_hash" not in {row[1] for row in cur.execute("PRAGMA table_info(idempotency_keys)")}:
+            cur.execute("ALTER TABLE idempotency_keys ADD COLUMN request_hash TEXT")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at)")
+        
         self.conn.commit()
+        
+        try:
+            self.conn.execute("SELECT json_object('ok', 1)").fetchone()
+        except sqlite3.OperationalError:
+            self.json_enabled = False
+        
+        for shard in range(self.num_shards):
+            conn = self.shard_conn(shard)
+            conn.execute(MESSAGES_SCHEMA)
+            conn.execute(MESSAGES_INDEX)
+            conn.execute(ARCHIVE_SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_thread ON archived_messages(thread_id)")
+            conn.commit()
+            self.fts_enabled = setup_fts(conn) and self.fts_enabled
     
-    def create_thread(self, thread_name):
+    def fan_out(self, fn):
+        """Run fn(shard_conn) on every shard in parallel and return the per-shard results"""
+        if self.executor is None:
+            return [fn(self.shard_conn(0))]
+        return list(self.executor.map(lambda shard: fn(self.shard_conn(shard)), range(self.num_shards)))
+    
+    def create_thread(self, thread_name, user_id=None):
         """Create a new thread"""
         cur = self.conn.cursor()
         cur.execute(
-            "INSERT INTO threads (thread_name, created_at) VALUES (?, ?)",
-            (thread_name, datetime.datetime.now().isoformat())
+            "INSERT INTO threads (thread_name, created_at, user_id) VALUES (?, ?, ?)",
+            (thread_name, datetime.datetime.now().isoformat(), user_id)
         )
+        thread_id = cur.lastrowid
         self.conn.commit()
-        return cur.lastrowid
+        self.shard_for_thread(thread_id, assign=True)
+        return thread_id
     
     def add_message(self, thread_id, role, content, embedding=None, user_id=None, timestamp=None):
         """Add a message to a thread"""
         if timestamp is None:
             timestamp = datetime.datetime.now().isoformat()
         
-        cur = self.conn.cursor()
-        cur.execute(
-            "INSERT INTO messages (thread_id, role, content, embedding, user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-            (thread_id, role, content, embedding, user_id, timestamp)
-        )
-        self.conn.commit()
+        sql = "INSERT INTO messages (thread_id, role, content, embedding, user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)"
+        params = (thread_id, role, content, embedding, user_id, timestamp)
+        shard = self.shard_for_thread(thread_id, assign=True)
+        if self.writers is not None:
+            return self.writers[shard].submit(sql, params)
+        
+        conn = self.shard_conn(shard)
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        conn.commit()
+        return cur.lastrowid
+    
+    def delete_message(self, thread_id, msg_id):
+        """Remove one message (and its share of the thread centroid)"""
+        conn = self.conn_for_thread(thread_id)
+        row = conn.execute(
+            "SELECT embedding FROM messages WHERE thread_id=? AND msg_id=?",
+            (thread_id, msg_id)
+        ).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM messages WHERE thread_id=? AND msg_id=?", (thread_id, msg_id))
+        conn.commit()
+        self.update_centroid_blobs(thread_id, [row[0]], weight=-1)
+        return True
     
     def get_thread_history(self, thread_id, n=10):
-        """Get conversation history for a thread"""
-        cur = self.conn.cursor()
+        """Get conversation history for a thread as MessageRecords"""
+        cur = self.conn_for_thread(thread_id).cursor()
+        cur.row_factory = message_record_factory
         cur.execute(
             '''SELECT role, content FROM messages
                WHERE thread_id=? ORDER BY msg_id DESC LIMIT ?''',
@@ -78,6 +387,55 @@ class DBManager:
         res = cur.fetchall()
         return res[::-1]  # Return oldest first
     
+    def get_thread_history_json(self, thread_id, n=10):
+        """
+        Same rows as get_thread_history, but each already encoded as a JSON
+        object string by SQLite, so no per-row Python objects are built.
+        Returns None when SQLite lacks the JSON functions.
+        """
+        if not self.json_enabled:
+            return None
+        cur = self.conn_for_thread(thread_id).cursor()
+        cur.execute(
+            '''SELECT json_object('role', role, 'content', content) FROM messages
+               WHERE thread_id=? ORDER BY msg_id DESC LIMIT ?''',
+            (thread_id, n)
+        )
+        return [row[0] for row in reversed(cur.fetchall())]
+    
+    def iter_thread_export(self, thread_id, batch_size=500):
+        """
+        Yield every message of a thread (oldest first) as a JSON object string, batch by batch.
+        StreamingResponse advances the generator from whichever worker thread is free, so it
+        reads through its own connection instead of the thread-local one.
+        """
+        conn = sqlite3.connect(self.shard_files[self.shard_for_thread(thread_id)], check_same_thread=False)
+        try:
+            cur = conn.cursor()
+            if self.json_enabled:
+                cur.execute(
+                    '''SELECT json_object('msg_id', msg_id, 'role', role, 'content', content,
+                                          'user_id', user_id, 'timestamp', timestamp)
+                       FROM messages WHERE thread_id=? ORDER BY msg_id''',
+                    (thread_id,)
+                )
+                encode = lambda row: row[0]
+            else:
+                cur.execute(
+                    "SELECT msg_id, role, content, user_id, timestamp FROM messages WHERE thread_id=? ORDER BY msg_id",
+                    (thread_id,)
+                )
+                keys = ("msg_id", "role", "content", "user_id", "timestamp")
+                encode = lambda row: json.dumps(dict(zip(keys, row)))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield encode(row)
+        finally:
+            conn.close()
+    
     def list_threads(self):
         """List all threads"""
         cur = self.conn.cursor()
@@ -85,3 +443,285 @@ class DBManager:
             "SELECT thread_id, thread_name, created_at FROM threads ORDER BY thread_id DESC"
         )
         return cur.fetchall()
+    
+    def update_centroid(self, thread_id, vector, weight=1):
+        """
+        Add (weight=1) or remove (weight=-1) one embedding from a thread's
+        centroid. Only an in-memory sum is touched here, so message writes
+        keep their group commit; flush_centroids() folds the sums into the
+        catalog every CENTROID_FLUSH_SECONDS and before centroids are read.
+        Sums still pending at a crash are lost; /admin/centroids/rebuild recovers.
+        """
+        vector = np.asarray(vector, dtype=np.float64)
+        with self.centroid_lock:
+            delta = self.centroid_deltas.get(thread_id)
+            if delta is None:
+                self.centroid_deltas[thread_id] = [weight * vector, weight]
+            else:
+                delta[0] = delta[0] + weight * vector
+                delta[1] += weight
+    
+    def update_centroid_blobs(self, thread_id, blobs, weight=1):
+        """update_centroid for pickled embedding blobs as stored in messages"""
+        for blob in blobs:
+            if blob:
+                self.update_centroid(thread_id, pickle.loads(blob), weight)
+    
+    def flush_centroids(self):
+        """Apply pending centroid sums as running means, all threads in one catalog transaction"""
+        with self.centroid_flush_lock:
+            with self.centroid_lock:
+                deltas, self.centroid_deltas = self.centroid_deltas, {}
+            if not deltas:
+                return 0
+            cur = self.conn.cursor()
+            for thread_id, (total, count) in deltas.items():
+                cur.execute("SELECT centroid, centroid_count FROM threads WHERE thread_id=?", (thread_id,))
+                row = cur.fetchone()
+                if row is None:
+                    continue
+                blob, stored = row
+                stored = stored or 0
+                if blob is not None and stored and len(blob) == total.size * 4:
+                    total = total + np.frombuffer(blob, dtype=np.float32) * stored
+                else:
+                    stored = 0
+                count += stored
+                centroid = (total / count).astype(np.float32).tobytes() if count > 0 else None
+                cur.execute(
+                    "UPDATE threads SET centroid=?, centroid_count=? WHERE thread_id=?",
+                    (centroid, max(count, 0), thread_id)
+                )
+            self.conn.commit()
+            return len(deltas)
+    
+    def _flush_centroids_loop(self):
+        while True:
+            time.sleep(CENTROID_FLUSH_SECONDS)
+            try:
+                self.flush_centroids()
+            except Exception as e:
+                print(f"Centroid flush failed: {e}")
+    
+    def set_centroid(self, thread_id, centroid, count):
+        """Overwrite a thread's centroid (rebuild); pending sums for it are dropped"""
+        with self.centroid_flush_lock:
+            with self.centroid_lock:
+                self.centroid_deltas.pop(thread_id, None)
+            self.conn.execute(
+                "UPDATE threads SET centroid=?, centroid_count=? WHERE thread_id=?",
+                (None if centroid is None else np.asarray(centroid, dtype=np.float32).tobytes(), count, thread_id)
+            )
+            self.conn.commit()
+    
+    def get_centroids(self, user_id=None, dim=None):
+        """
+        (thread_ids, names, centroid matrix) for threads that have a centroid.
+        With user_id, only that user's threads; unowned (legacy) threads are left out
+        like they are in search_messages, so they never surface for arbitrary callers.
+        With dim, centroids of another size (built by a different model) are skipped.
+        """
+        self.flush_centroids()
+        sql = "SELECT thread_id, thread_name, centroid FROM threads WHERE centroid IS NOT NULL"
+        params = []
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        rows = self.conn.execute(sql, params).fetchall()
+        if dim is not None:
+            rows = [row for row in rows if len(row[2]) == dim * 4]
+        if not rows:
+            return [], [], None
+        matrix = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, _, blob in rows])
+        return [r[0] for r in rows], [r[1] for r in rows], matrix
+    
+    def lexical_search(self, thread_id, text, limit=None, exclude_msg_id=None):
+        """BM25 matches within a thread as {msg_id: score}, higher is better"""
+        query = fts_query(text)
+        if not self.fts_enabled or not query:
+            return {}
+        # The thread_id column gets weight 0 so it filters without changing the scores
+        sql = '''SELECT rowid, -bm25(messages_fts, 1.0, 0.0) FROM messages_fts
+                 WHERE messages_fts MATCH ?'''
+        params = [f'thread_id : "{int(thread_id)}" AND content : ({query})']
+        if exclude_msg_id is not None:
+            sql += " AND rowid != ?"
+            params.append(exclude_msg_id)
+        sql += " ORDER BY bm25(messages_fts, 1.0, 0.0)"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        try:
+            return dict(self.conn_for_thread(thread_id).execute(sql, params).fetchall())
+        except sqlite3.OperationalError as e:
+            print(f"Lexical search failed: {e}")
+            return {}
+    
+    def search_messages(self, text, user_id=None, limit=50):
+        """Substring search over messages on every shard, newest first"""
+        pattern = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        sql = "SELECT thread_id, role, content, timestamp FROM messages WHERE content LIKE ? ESCAPE '\\'"
+        params = [f"%{pattern}%"]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        sql += " ORDER BY timestamp DESC LIMIT ?"
+        params.append(limit)
+        
+        results = []
+        for rows in self.fan_out(lambda conn: conn.execute(sql, params).fetchall()):
+            results.extend(rows)
+        results.sort(key=lambda row: row[3] or "", reverse=True)
+        return results[:limit]
+    
+    def shard_stats(self):
+        """Per-shard message/thread counts and file sizes"""
+        def collect(conn):
+            return conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT thread_id) FROM messages"
+            ).fetchone()
+        
+        stats = []
+        for shard, (messages, threads) in enumerate(self.fan_out(collect)):
+            path = self.shard_files[shard]
+            stats.append({
+                "shard": shard,
+                "file": path,
+                "messages": messages,
+                "threads": threads,
+                "size_bytes": os.path.getsize(path) if os.path.exists(path) else 0
+            })
+        return stats
+    
+    def archive_messages(self, thread_id, msg_ids, reason):
+        """Move messages into a compressed archive row for their thread"""
+        if not msg_ids:
+            return 0
+        conn = self.conn_for_thread(thread_id)
+        placeholders = ",".join("?" * len(msg_ids))
+        rows = conn.execute(
+            f'''SELECT msg_id, role, content, embedding, user_id, timestamp FROM messages
+                WHERE thread_id=? AND msg_id IN ({placeholders}) ORDER BY msg_id''',
+            (thread_id, *msg_ids)
+        ).fetchall()
+        if not rows:
+            return 0
+        conn.execute(
+            "INSERT INTO archived_messages (thread_id, reason, msg_count, payload, archived_at) VALUES (?, ?, ?, ?, ?)",
+            (thread_id, reason, len(rows), zlib.compress(pickle.dumps(rows)), datetime.datetime.now().isoformat())
+        )
+        conn.execute(
+            f"DELETE FROM messages WHERE thread_id=? AND msg_id IN ({placeholders})",
+            (thread_id, *msg_ids)
+        )
+        conn.commit()
+        if reason != "cold":
+            # A cold thread keeps its centroid (it is restored whole on next use); capped rows leave it
+            self.update_centroid_blobs(thread_id, [row[3] for row in rows], weight=-1)
+        return len(rows)
+    
+    def load_archived(self, thread_id, reason=None):
+        """Decompress archived rows (msg_id, role, content, embedding, user_id, timestamp), oldest first"""
+        sql = "SELECT payload FROM archived_messages WHERE thread_id=?"
+        params = [thread_id]
+        if reason is not None:
+            sql += " AND reason=?"
+            params.append(reason)
+        rows = []
+        for (payload,) in self.conn_for_thread(thread_id).execute(sql + " ORDER BY archive_id", params):
+            rows.extend(pickle.loads(zlib.decompress(payload)))
+        rows.sort(key=lambda row: row[0])
+        return rows
+    
+    def has_archive(self, thread_id, reason=None):
+        sql = "SELECT 1 FROM archived_messages WHERE thread_id=?"
+        params = [thread_id]
+        if reason is not None:
+            sql += " AND reason=?"
+            params.append(reason)
+        return self.conn_for_thread(thread_id).execute(sql + " LIMIT 1", params).fetchone() is not None
+    
+    def restore_archived(self, thread_id, reason=None):
+        """Move archived rows back into messages, keeping their original msg_id"""
+        rows = self.load_archived(thread_id, reason)
+        if not rows:
+            return 0
+        # Rows archived for any reason but "cold" were taken out of the centroid
+        if reason is None:
+            recounted = self.load_archived(thread_id, "cap")
+        else:
+            recounted = [] if reason == "cold" else rows
+        conn = self.conn_for_thread(thread_id)
+        cur = conn.cursor()
+        for msg_id, role, content, emb, uid, ts in rows:
+            cur.execute(
+                "INSERT OR IGNORE INTO messages (msg_id, thread_id, role, content, embedding, user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (msg_id, thread_id, role, content, emb, uid, ts)
+            )
+            if cur.rowcount == 0:
+                # The id was reused after a reshard; keep the row under a fresh id
+                cur.execute(
+                    "INSERT INTO messages (thread_id, role, content, embedding, user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                    (thread_id, role, content, emb, uid, ts)
+                )
+        sql = "DELETE FROM archived_messages WHERE thread_id=?"
+        params = [thread_id]
+        if reason is not None:
+            sql += " AND reason=?"
+            params.append(reason)
+        conn.execute(sql, params)
+        conn.commit()
+        self.update_centroid_blobs(thread_id, [row[3] for row in recounted])
+        return len(rows)
+    
+    def claim_idempotency_key(self, idem_key, request_hash=None):
+        """
+        Try to claim an idempotency key for a new request.
+        Returns (True, None) if claimed, (False, response) if a completed
+        result exists, or (False, None) if the key is still in progress.
+        Raises ValueError when the key was claimed for a different request body.
+        """
+        now = datetime.datetime.now()
+        stale_before = (now - datetime.timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT)).isoformat()
+        expired_before = (now - datetime.timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)).isoformat()
+        cur = self.conn.cursor()
+        # A pending claim this old belongs to a request that died; let the retry take it over
+        cur.execute(
+            "DELETE FROM idempotency_keys WHERE idem_key=? AND status='pending' AND created_at < ?",
+            (idem_key, stale_before)
+        )
+        # Stored results are only replayed for IDEMPOTENCY_TTL_SECONDS
+        cur.execute(
+            "DELETE FROM idempotency_keys WHERE status='done' AND created_at < ?",
+            (expired_before,)
+        )
+        cur.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (idem_key, status, response, created_at, request_hash) VALUES (?, 'pending', NULL, ?, ?)",
+            (idem_key, now.isoformat(), request_hash)
+        )
+        self.conn.commit()
+        if cur.rowcount == 1:
+            return True, None
+        
+        cur.execute("SELECT status, response, request_hash FROM idempotency_keys WHERE idem_key=?", (idem_key,))
+        row = cur.fetchone()
+        if row and row[2] is not None and request_hash is not None and row[2] != request_hash:
+            raise ValueError("Idempotency key was already used with a different request")
+        if row and row[0] == 'done':
+            return False, row[1]
+        return False, None
+    
+    def complete_idempotency_key(self, idem_key, response):
+        """Store the serialized result for a claimed key"""
+        cur = self.conn.cursor()
+        cur.execute(
+            "UPDATE idempotency_keys SET status='done', response=? WHERE idem_key=?",
+            (response, idem_key)
+        )
+        self.conn.commit()
+    
+    def release_idempotency_key(self, idem_key):
+        """Drop a pending claim so the request can be retried"""
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM idempotency_keys WHERE idem_key=? AND status='pending'", (idem_key,))
+        self.conn.commit()
@@ -0,0 +1,122 @@
+"""
+Fake Ollama backend for exercising LLM timeouts, retries and the circuit breaker.
+
+    python fake_ollama.py --port 11500 --delay 2 --error-rate 0.3
+    OLLAMA_URL=http://localhost:11500 python api_server.py
+
+Faults can be changed while it runs:
+
+    curl -X POST localhost:11500/fault -d '{"error_rate": 1}'
+    curl -X POST localhost:11500/fault -d '{"stall_rate": 0.5, "stall_seconds": 120}'
+
+/api/generate streams the prompt's first words back as NDJSON chunks, ending
+with a done chunk that carries a context array, like the real server.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+faults = {
+    "delay": 0.0,          # seconds before the first byte
+    "chunk_delay": 0.0,    # seconds between chunks
+    "error_rate": 0.0,     # fraction of calls answered with HTTP 500
+    "stall_rate": 0.0,     # fraction of calls that stall mid-stream
+    "stall_seconds": 300.0,
+    "truncate_rate": 0.0   # fraction of calls that end without a done chunk
+}
+faults_lock = threading.Lock()
+calls = {"total": 0}
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, obj):
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send_json(200, {"models": [{"name": "fake"}]})
+        elif self.path == "/fault":
+            with faults_lock:
+                self.send_json(200, {**faults, **calls})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path == "/fault":
+            update = self.read_json()
+            with faults_lock:
+                faults.update({k: float(v) for k, v in update.items() if k in faults})
+                self.send_json(200, dict(faults))
+            return
+        if self.path != "/api/generate":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        payload = self.read_json()
+        with faults_lock:
+            f = dict(faults)
+            calls["total"] += 1
+        time.sleep(f["delay"])
+        if random.random() < f["error_rate"]:
+            self.send_json(500, {"error": "injected failure"})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = payload.get("prompt", "").split()[-8:] or ["ok"]
+        stall_at = random.randrange(len(words)) if random.random() < f["stall_rate"] else None
+        truncate = random.random() < f["truncate_rate"]
+        try:
+            for i, word in enumerate(words):
+                if i == stall_at:
+                    time.sleep(f["stall_seconds"])
+                self.write_chunk({"model": payload.get("model"), "response": word + " ", "done": False})
+                time.sleep(f["chunk_delay"])
+            if not truncate:
+                context = list(payload.get("context", [])) + list(range(len(words)))
+                self.write_chunk({
+                    "model": payload.get("model"),
+                    "response": "",
+                    "done": True,
+                    "context": context,
+                    "prompt_eval_count": len(words),
+                    "prompt_eval_duration": 1000000 * len(words)
+                })
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up (timeout), which is the point of a stall
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama server with injectable delays and errors")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    for name, value in faults.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=float, default=value)
+    args = parser.parse_args()
+    faults.update({name: getattr(args, name) for name in faults})
+    server = ThreadingHTTPServer((args.host, args.port), FakeOllamaHandler)
+    print(f"Fake Ollama on http://{args.host}:{args.port} with faults {faults}")
+    server.serve_forever()
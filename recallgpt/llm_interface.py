@@ -1,21 +1,366 @@
 import requests
 import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from response_cache import ResponseCache
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+LLM_CONTEXT_CACHE_SIZE = int(os.getenv("LLM_CONTEXT_CACHE_SIZE", "256"))
+LLM_CONTEXT_MAX_TOKENS = int(os.getenv("LLM_CONTEXT_MAX_TOKENS", "2048"))  # rebuild past this, before num_ctx truncates
+LLM_RESPONSE_CACHE_ENABLED = os.getenv("LLM_RESPONSE_CACHE_ENABLED", "False").lower() == "true"
+LLM_RESPONSE_CACHE_FILE = os.getenv("LLM_RESPONSE_CACHE_FILE", "llm_cache.db")
+LLM_RESPONSE_CACHE_TTL = int(os.getenv("LLM_RESPONSE_CACHE_TTL", "3600"))
+LLM_RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("LLM_RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))  # max gap between streamed chunks
+LLM_TOTAL_TIMEOUT = float(os.getenv("LLM_TOTAL_TIMEOUT", "180"))  # whole call, retries included
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "8"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "100"))
+
+class LLMUnavailableError(Exception):
+    """The backend can't serve this call right now; retry_after is a hint in seconds"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class LLMTimeoutError(LLMUnavailableError):
+    """The call ran past LLM_TOTAL_TIMEOUT"""
+
+class LLMBackendError(Exception):
+    """5xx or truncated stream from the backend; worth retrying"""
+
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, LLMBackendError)
+
+def is_deterministic(options):
+    """Sampling is reproducible only with greedy decoding or a fixed seed"""
+    if not options:
+        return False
+    return options.get('temperature') == 0 or options.get('seed') is not None
 
 class LLMInterface:
-    def __init__(self, model_name="qwen2.5-coder:1.5b"):
-        self.api_url = 'http://localhost:11434/api/generate'
+    def __init__(self, model_name="qwen2.5-coder:1.5b", context_cache_size=LLM_CONTEXT_CACHE_SIZE,
+                 context_max_tokens=LLM_CONTEXT_MAX_TOKENS,
+                 response_cache_enabled=LLM_RESPONSE_CACHE_ENABLED, base_url=OLLAMA_URL,
+                 max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE):
+        self.api_url = base_url.rstrip('/') + '/api/generate'
         self.model_name = model_name
+        self.connect_timeout = LLM_CONNECT_TIMEOUT
+        self.read_timeout = LLM_READ_TIMEOUT
+        self.total_timeout = LLM_TOTAL_TIMEOUT
+        self.max_retries = LLM_MAX_RETRIES
+        self.retry_backoff = LLM_RETRY_BACKOFF
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+        # Bounds how many request threads can sit in a generation; the rest are turned away
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        self.latencies = deque(maxlen=LLM_LATENCY_WINDOW)
+        self.response_cache = None
+        if response_cache_enabled:
+            self.response_cache = ResponseCache(
+                LLM_RESPONSE_CACHE_FILE,
+                ttl_seconds=LLM_RESPONSE_CACHE_TTL,
+                max_entries=LLM_RESPONSE_CACHE_MAX_ENTRIES
+            )
+        # thread_id -> {"context": [...], "base": ordered history keys of the full prompt,
+        #               "turns": keys of the turns generated on top of it}, LRU ordered
+        self.context_cache = OrderedDict()
+        self.context_cache_size = context_cache_size
+        self.context_max_tokens = context_max_tokens
+        self.lock = threading.Lock()
+        self.stats = {
+            "full_prompt_calls": 0,
+            "context_reuse_calls": 0,
+            "full_prompt_eval_ms": 0.0,
+            "full_prompt_eval_tokens": 0,
+            "reuse_prompt_eval_ms": 0.0,
+            "reused_context_tokens": 0,
+            "context_rebuilds_history_changed": 0,
+            "context_rebuilds_too_long": 0,
+        }
+        self.health = {
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "rejected_queue_full": 0,
+            "last_success_at": None,
+            "last_error": None,
+            "last_error_at": None,
+        }
+
+    @staticmethod
+    def _message_key(role, content):
+        return hash((role, content))
+
+    def _get_context(self, thread_id, history):
+        """
+        Return the stored context for a thread if the retrieved history, leaving out
+        turns already generated on that context, is exactly (same messages, same
+        order) the history the context was built from, and the context is still
+        within context_max_tokens. Otherwise the entry is dropped.
+        """
+        keys = [self._message_key(role, content) for role, content in history]
+        with self.lock:
+            entry = self.context_cache.get(thread_id)
+            if entry is None:
+                return None
+            if len(entry["context"]) > self.context_max_tokens:
+                self.stats["context_rebuilds_too_long"] += 1
+            elif tuple(k for k in keys if k not in entry["turns"]) != entry["base"]:
+                self.stats["context_rebuilds_history_changed"] += 1
+            else:
+                self.context_cache.move_to_end(thread_id)
+                return entry
+            del self.context_cache[thread_id]
+            return None
+
+    def _store_context(self, thread_id, context, base, turns):
+        with self.lock:
+            self.context_cache[thread_id] = {"context": context, "base": base, "turns": turns}
+            self.context_cache.move_to_end(thread_id)
+            while len(self.context_cache) > self.context_cache_size:
+                self.context_cache.popitem(last=False)
+
+    def _record_stats(self, final_chunk, reused_entry):
+        eval_ms = final_chunk.get('prompt_eval_duration', 0) / 1e6
+        eval_tokens = final_chunk.get('prompt_eval_count', 0)
+        with self.lock:
+            if reused_entry is None:
+                self.stats["full_prompt_calls"] += 1
+                self.stats["full_prompt_eval_ms"] += eval_ms
+                self.stats["full_prompt_eval_tokens"] += eval_tokens
+            else:
+                self.stats["context_reuse_calls"] += 1
+                self.stats["reuse_prompt_eval_ms"] += eval_ms
+                self.stats["reused_context_tokens"] += len(reused_entry["context"])
+
+    def get_stats(self):
+        """Context reuse counters plus an estimate of prompt-eval time saved"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["cached_threads"] = len(self.context_cache)
+        ms_per_token = (
+            stats["full_prompt_eval_ms"] / stats["full_prompt_eval_tokens"]
+            if stats["full_prompt_eval_tokens"] else 0.0
+        )
+        # Tokens carried in a reused context would otherwise have been re-evaluated
+        stats["estimated_prompt_eval_ms_saved"] = stats["reused_context_tokens"] * ms_per_token
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.get_stats()
+        return stats
+
+    def check_available(self):
+        """Fail fast (before any writes) while the circuit is open"""
+        try:
+            self.breaker.check()
+        except CircuitOpenError as e:
+            raise LLMUnavailableError(f"LLM backend unavailable: {e}", retry_after=e.retry_after)
+
+    def _acquire_slot(self):
+        if self.slots.acquire(blocking=False):
+            with self.lock:
+                self.in_flight += 1
+            return
+        with self.lock:
+            if self.queued >= self.max_queue:
+                self.health["rejected_queue_full"] += 1
+                raise LLMUnavailableError("LLM generation queue is full", retry_after=1)
+            self.queued += 1
+        acquired = self.slots.acquire(timeout=LLM_QUEUE_TIMEOUT)
+        with self.lock:
+            self.queued -= 1
+            if not acquired:
+                self.health["rejected_queue_full"] += 1
+                raise LLMUnavailableError("Timed out waiting for a free LLM slot", retry_after=1)
+            self.in_flight += 1
+
+    def _release_slot(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def _record_outcome(self, latency=None, error=None):
+        with self.lock:
+            if error is None:
+                self.health["successes"] += 1
+                self.health["last_success_at"] = time.time()
+                self.latencies.append(latency * 1000)
+            else:
+                self.health["failures"] += 1
+                self.health["last_error"] = str(error)
+                self.health["last_error_at"] = time.time()
+
+    def get_health(self):
+        """Circuit state, queue depth, recent latency and error counters"""
+        circuit = self.breaker.get_state()
+        with self.lock:
+            health = dict(self.health)
+            latencies = sorted(self.latencies)
+            health.update(in_flight=self.in_flight, queued=self.queued,
+                          max_concurrency=self.max_concurrency, max_queue=self.max_queue)
+        if latencies:
+            health["latency_ms"] = {
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                "max": latencies[-1],
+                "samples": len(latencies)
+            }
+        else:
+            health["latency_ms"] = None
+        if circuit["state"] == "open":
+            status = "unavailable"
+        elif circuit["state"] == "half_open" or circuit["consecutive_failures"] or health["queued"] >= self.max_queue:
+            status = "degraded"
+        else:
+            status = "ok"
+        return {"status": status, "backend": self.api_url, "circuit": circuit, **health}
+
+    def generate(self, prompt, thread_id=None, history=None, message=None, followup_prompt=None, options=None,
+                 cache_scope=None):
+        """
+        Generate a completion for prompt.
+        When thread_id is given, the context Ollama returns is kept per thread. On the next
+        turn, if the retrieved history is unchanged (see _get_context), only followup_prompt
+        (the current question) is sent together with the stored context. Otherwise the
+        full prompt is sent and the context is rebuilt.
+        With the response cache enabled, deterministic calls (temperature 0 or a fixed seed)
+        are served from the cache and identical in-flight calls share one generation. The
+        key covers cache_scope instead of the prompt when given (see turn_cache_scope).
+        Raises LLMUnavailableError when the circuit is open, the queue is full, or the
+        backend keeps failing after retries (LLMTimeoutError past the total timeout).
+        """
+        def run():
+            self._acquire_slot()
+            try:
+                return self._generate(prompt, thread_id, history, message, followup_prompt, options)
+            finally:
+                self._release_slot()
+
+        if self.response_cache is not None and is_deterministic(options):
+            key = ResponseCache.make_key(self.model_name, options, prompt if cache_scope is None else cache_scope)
+            return self.response_cache.get_or_compute(key, run)
+        return run()
+
+    def _generate(self, prompt, thread_id, history, message, followup_prompt, options):
+        history = history or []
+        reused_entry = None
+        if thread_id is not None and followup_prompt is not None:
+            reused_entry = self._get_context(thread_id, history)
 
-    def generate(self, prompt):
         payload = {'model': self.model_name, 'prompt': prompt}
-        response = requests.post(self.api_url, json=payload, stream=True)
-        full_response = ""
-        for line in response.iter_lines():
-            if line:
-                try:
-                    data = json.loads(line.decode('utf-8'))
-                    chunk = data.get('response', '')
-                    full_response += chunk
-                except Exception as e:
-                    print(f"Error decoding chunk: {e}")
+        if reused_entry is not None:
+            payload['prompt'] = followup_prompt
+            payload['context'] = reused_entry["context"]
+        if options:
+            payload['options'] = options
+
+        full_response, final_chunk = self._post_with_retries(payload)
+        self._record_stats(final_chunk, reused_entry)
+        if thread_id is not None and final_chunk.get('context'):
+            if reused_entry is not None:
+                base, turns = reused_entry["base"], set(reused_entry["turns"])
+            else:
+                base = tuple(self._message_key(role, content) for role, content in history)
+                turns = set()
+            if message is not None:
+                turns.add(self._message_key("user", message))
+            turns.add(self._message_key("assistant", full_response))
+            self._store_context(thread_id, final_chunk['context'], base, turns)
         return full_response
+
+    def _post_with_retries(self, payload):
+        """
+        Call the backend through the circuit breaker, retrying connection errors,
+        timeouts and 5xx with exponential backoff and full jitter.
+        """
+        deadline = time.monotonic() + self.total_timeout
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError as e:
+                raise LLMUnavailableError(f"LLM backend unavailable: {e}", retry_after=e.retry_after)
+            start = time.monotonic()
+            try:
+                result = self._stream(payload, deadline)
+            except LLMTimeoutError as e:
+                self.breaker.record_failure()
+                self._record_outcome(error=e)
+                with self.lock:
+                    self.health["timeouts"] += 1
+                raise
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                self._record_outcome(error=e)
+                attempt += 1
+                delay = random.uniform(0, self.retry_backoff * 2 ** attempt)
+                retry_after = self.breaker.get_state().get("retry_after_seconds")
+                if attempt > self.max_retries:
+                    raise LLMUnavailableError(
+                        f"LLM backend failed after {attempt} attempt(s): {e}",
+                        retry_after=retry_after
+                    ) from e
+                if time.monotonic() + delay >= deadline:
+                    # Retries were still allowed; the total timeout is what ran out
+                    with self.lock:
+                        self.health["timeouts"] += 1
+                    raise LLMTimeoutError(
+                        f"LLM call exceeded {self.total_timeout:.0f}s after {attempt} attempt(s): {e}",
+                        retry_after=retry_after
+                    ) from e
+                with self.lock:
+                    self.health["retries"] += 1
+                time.sleep(delay)
+                continue
+            except Exception as e:
+                # A 4xx or bad payload is our problem, not a sign the backend is down:
+                # it counts as a failed call in health but releases the breaker
+                self.breaker.record_success()
+                self._record_outcome(error=e)
+                raise
+            self.breaker.record_success()
+            self._record_outcome(latency=time.monotonic() - start)
+            return result
+
+    def _stream(self, payload, deadline):
+        """One streamed /api/generate call -> (text, final chunk)"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise LLMTimeoutError(f"LLM call exceeded {self.total_timeout:.0f}s")
+        # The read timeout bounds each socket read, so a stalled stream overshoots the deadline by at most that
+        timeout = (self.connect_timeout, min(self.read_timeout, remaining))
+        with requests.post(self.api_url, json=payload, stream=True, timeout=timeout) as response:
+            if response.status_code >= 500:
+                raise LLMBackendError(f"LLM backend returned {response.status_code}")
+            response.raise_for_status()
+            full_response = ""
+            final_chunk = None
+            for line in response.iter_lines():
+                if time.monotonic() > deadline:
+                    raise LLMTimeoutError(f"LLM call exceeded {self.total_timeout:.0f}s")
+                if line:
+                    try:
+                        data = json.loads(line.decode('utf-8'))
+                        chunk = data.get('response', '')
+                        full_response += chunk
+                        if data.get('done'):
+                            final_chunk = data
+                    except Exception as e:
+                        print(f"Error decoding chunk: {e}")
+        if final_chunk is None:
+            raise LLMBackendError("LLM stream ended before completion")
+        return full_response, final_chunk
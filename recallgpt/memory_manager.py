@@ -1,47 +1,204 @@
-from db_manager import DBManager
+from db_manager import DBManager, MessageRecord
 from sentence_transformers import SentenceTransformer
 import pickle
 import numpy as np
 import datetime
 import json
 import os
+import time
+from collections import OrderedDict
+import threading
 from datetime import datetime
 
+LEXICAL_WEIGHT = float(os.getenv("LEXICAL_WEIGHT", "0.3"))
+FUSION_METHOD = os.getenv("FUSION_METHOD", "weighted")  # weighted | rrf
+LEXICAL_PREFILTER_THRESHOLD = int(os.getenv("LEXICAL_PREFILTER_THRESHOLD", "5000"))
+LEXICAL_PREFILTER_LIMIT = int(os.getenv("LEXICAL_PREFILTER_LIMIT", "500"))
+LEXICAL_PREFILTER_RECENT = int(os.getenv("LEXICAL_PREFILTER_RECENT", "50"))
+RRF_K = 60
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Weighted RRF over (scores, weight, matched_only) lists: each list adds
+    weight / (k + rank). With matched_only, zero-score entries add nothing.
+    """
+    fused = np.zeros(len(rankings[0][0]))
+    for scores, weight, matched_only in rankings:
+        if not weight:
+            continue
+        ranks = np.empty(len(scores))
+        ranks[np.argsort(-scores, kind="stable")] = np.arange(1, len(scores) + 1)
+        contribution = weight / (k + ranks)
+        if matched_only:
+            contribution[scores <= 0] = 0.0
+        fused += contribution
+    return fused
+
+MMR_CANDIDATES = int(os.getenv("MMR_CANDIDATES", "200"))
+
+def mmr_order(embeddings, relevance, mmr_lambda=0.7, dedup_threshold=0.95):
+    """
+    Lazily yield indices in maximal-marginal-relevance order.
+    Keeps a running max-similarity-to-selected per candidate, so each pick
+    costs one (n x d) matrix-vector product: O(n * selected) overall.
+    Candidates at or above dedup_threshold cosine similarity to a picked
+    message are collapsed (never yielded).
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    unit = embeddings / np.maximum(norms, 1e-10)
+    spread = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones(len(relevance))
+    
+    max_sim = np.zeros(len(relevance))
+    available = np.ones(len(relevance), dtype=bool)
+    while available.any():
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_sim
+        scores[~available] = -np.inf
+        idx = int(np.argmax(scores))
+        available[idx] = False
+        yield idx
+        sims = unit @ unit[idx]
+        available &= sims < dedup_threshold
+        np.maximum(max_sim, sims, out=max_sim)
+
 class MemoryManager:
     def __init__(self, db_file='recallgpt.db'):
         self.db = DBManager(db_file)
         self.model = SentenceTransformer('all-MiniLM-L6-v2')
         self.logger = RetrievalLogger()
+        self.query_cache = OrderedDict()  # query text -> embedding, LRU
+        self.query_cache_lock = threading.Lock()
+
+    def encode_query(self, query):
+        """Encode a retrieval query, reusing recent encodings (tuning loops repeat queries)"""
+        with self.query_cache_lock:
+            if query in self.query_cache:
+                self.query_cache.move_to_end(query)
+                return self.query_cache[query]
+        embedding = self.model.encode(query)
+        with self.query_cache_lock:
+            self.query_cache[query] = embedding
+            while len(self.query_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+        return embedding
 
-    def create_thread(self, thread_name):
-        return self.db.create_thread(thread_name)
+    def create_thread(self, thread_name, user_id=None):
+        return self.db.create_thread(thread_name, user_id=user_id)
 
-    def add_message(self, thread_id, role, content, user_id=None):
+    def add_message(self, thread_id, role, content, user_id=None, embedding=None):
         if role in ["user", "assistant"]:
-            vector = self.model.encode(content)
+            vector = embedding if embedding is not None else self.model.encode(content)
             embedding_blob = pickle.dumps(vector)
         else:
+            vector = None
             embedding_blob = None
-        self.db.add_message(thread_id, role, content, embedding_blob, user_id)
+        # A thread archived as cold comes back to life when it is used again
+        if self.db.has_archive(thread_id, reason="cold"):
+            self.db.restore_archived(thread_id, reason="cold")
+        msg_id = self.db.add_message(thread_id, role, content, embedding_blob, user_id)
+        if vector is not None:
+            self.db.update_centroid(thread_id, vector)
+        return msg_id
 
-    def get_recent_history(self, thread_id, n=10):
-        """Get recent conversation history"""
-        cur = self.db.conn.cursor()
+    def turn_cache_scope(self, thread_id, message, params):
+        """
+        Response-cache identity of a chat turn, taken before the turn is stored:
+        the thread's newest msg_id once trailing repeats of this same message
+        (and their replies) are skipped, so a retry, regenerate or duplicate
+        submit maps to the key of the first attempt.
+        """
+        cur = self.db.conn_for_thread(thread_id).cursor()
         cur.execute(
-            '''SELECT role, content FROM messages
-            WHERE thread_id=? ORDER BY msg_id DESC LIMIT ?''',
-            (thread_id, n)
+            "SELECT msg_id, role, content FROM messages WHERE thread_id = ? ORDER BY timestamp DESC, msg_id DESC",
+            (thread_id,)
         )
-        res = cur.fetchall()
-        return res[::-1]  # Return oldest first
+        state = 0
+        reply_id = None  # newest assistant reply, kept until we know whether it answers a repeat
+        for msg_id, role, content in cur:
+            if role == "assistant" and reply_id is None:
+                reply_id = msg_id
+                continue
+            if role == "user" and content == message:
+                reply_id = None
+                continue
+            state = reply_id if reply_id is not None else msg_id
+            break
+        else:
+            state = reply_id or 0
+        return json.dumps([thread_id, message, state, params], sort_keys=True)
+
+    def suggest_threads(self, query, top_n=5, user_id=None, query_emb=None):
+        """Threads whose centroid embedding is closest to the query: [(thread_id, thread_name, score)]"""
+        if query_emb is None:
+            query_emb = self.encode_query(query)
+        query_emb = np.asarray(query_emb, dtype=np.float32)
+        thread_ids, names, centroids = self.db.get_centroids(user_id, dim=len(query_emb))
+        if centroids is None:
+            return []
+        norms = np.linalg.norm(centroids, axis=1) * (np.linalg.norm(query_emb) + 1e-10)
+        scores = centroids @ query_emb / np.maximum(norms, 1e-10)
+        top = np.argsort(scores)[::-1][:top_n]
+        return [(thread_ids[i], names[i], float(scores[i])) for i in top]
+
+    def search_across_threads(self, query, user_id=None, top_threads=5, top_k=10, max_tokens=4000):
+        """
+        User-wide search: centroids pick the top_threads candidate threads,
+        then message-level hybrid scoring runs only inside those.
+        """
+        query_emb = self.encode_query(query)
+        threads = self.suggest_threads(query, top_n=top_threads, user_id=user_id, query_emb=query_emb)
+        results = []
+        for thread_id, thread_name, thread_score in threads:
+            matches = self.retrieve_with_scores(
+                thread_id, query, top_k=top_k, max_tokens=max_tokens,
+                exclude_latest=False, query_emb=query_emb
+            )
+            for msg in matches["messages"]:
+                results.append({
+                    "thread_id": thread_id,
+                    "thread_name": thread_name,
+                    "thread_score": thread_score,
+                    **msg
+                })
+        # final_score is only comparable within a thread, so weight it by how well the thread matched
+        for msg in results:
+            msg["combined_score"] = msg["final_score"] * max(msg["thread_score"], 0.0)
+        results.sort(key=lambda msg: msg["combined_score"], reverse=True)
+        return results[:top_k]
+
+    def rebuild_centroids(self):
+        """Recompute every thread centroid from stored embeddings (backfill for existing DBs)"""
+        self.db.flush_centroids()
+        rebuilt = 0
+        for thread_id, _, _ in self.db.list_threads():
+            candidates = self.load_candidates(thread_id, exclude_latest=False)
+            if candidates["embeddings"] is None:
+                self.db.set_centroid(thread_id, None, 0)
+                continue
+            self.db.set_centroid(thread_id, candidates["embeddings"].mean(axis=0), len(candidates["msg_ids"]))
+            rebuilt += 1
+        return rebuilt
+
+    def get_recent_history(self, thread_id, n=10, include_archived=False):
+        """Get recent conversation history as MessageRecords, oldest first"""
+        res = self.db.get_thread_history(thread_id, n)
+        if include_archived and len(res) < n:
+            # Archived rows are only decompressed when live history runs out
+            archived = [MessageRecord(role, content) for _, role, content, _, _, _ in self.db.load_archived(thread_id)]
+            res = archived[-(n - len(res)):] + res
+        return res
 
 
     def list_threads(self):
         return self.db.list_threads()
+
+    def search_messages(self, text, user_id=None, limit=50):
+        return self.db.search_messages(text, user_id=user_id, limit=limit)
     
     def get_semantic_matches(self, thread_id, query, model, top_k=5):
         # Use self.db for DB queries, just as you do everywhere else.
-        cur = self.db.conn.cursor()
+        cur = self.db.conn_for_thread(thread_id).cursor()
         cur.execute("SELECT msg_id, embedding, role, content FROM messages WHERE thread_id = ?", (thread_id,))
         records = cur.fetchall()
         
@@ -68,7 +225,7 @@ class MemoryManager:
         Hybrid retrieval: combines semantic similarity (70%) + recency (30%)
         Returns the top_k most relevant AND recent messages
         """
-        cur = self.db.conn.cursor()
+        cur = self.db.conn_for_thread(thread_id).cursor()
         cur.execute("""
             SELECT msg_id, embedding, role, content, timestamp 
             FROM messages 
@@ -128,52 +285,163 @@ class MemoryManager:
         """
         return len(text) // 4
 
-    def get_hybrid_matches_with_token_limit(self, thread_id, query, top_k=5, max_tokens=2000, semantic_weight=0.7, recency_weight=0.3):
-        """
-        Hybrid retrieval with token limit awareness.
-        Returns messages that fit within max_tokens budget.
-        """
-        import pickle
-        import numpy as np
-        import datetime
-        
-        cur = self.db.conn.cursor()
-        cur.execute("""
-            SELECT msg_id, embedding, role, content, timestamp 
-            FROM messages 
-            WHERE thread_id = ? 
-            ORDER BY timestamp ASC
-        """, (thread_id,))
-        
-        records = cur.fetchall()
-        
-        if not records:
-            return []
-        
-        # Prepare data - SKIP THE VERY LAST MESSAGE (the current query)
+    def _build_candidates(self, records):
+        """Turn (msg_id, embedding, role, content, timestamp) rows into scoring arrays"""
+        msg_ids = []
         embeddings = []
         payloads = []
         timestamps = []
         
-        # Process all messages EXCEPT the last one (which is the current query)
-        for msg_id, emb_blob, role, content, ts in records[:-1]:  # ✅ Exclude last message
+        for msg_id, emb_blob, role, content, ts in records:
             if emb_blob:
                 try:
                     embedding = pickle.loads(emb_blob)
                     embeddings.append(embedding)
-                    payloads.append((role, content))
-                    timestamps.append(datetime.datetime.fromisoformat(ts))
+                    msg_ids.append(msg_id)
+                    payloads.append(MessageRecord(role, content))
+                    timestamps.append(datetime.fromisoformat(ts))
                 except Exception:
                     pass
         
-        if not embeddings:
-            return []
+        return {
+            "msg_ids": msg_ids,
+            "embeddings": np.array(embeddings) if embeddings else None,
+            "payloads": payloads,
+            "timestamps": timestamps
+        }
+
+    def append_candidate(self, candidates, msg_id, role, content, embedding, timestamp=None):
+        """
+        Add a just-stored message to already loaded candidates (used across batch turns).
+        Rows go into a buffer with spare capacity that doubles when full, and
+        candidates["embeddings"] is a view of its filled part, so a turn does not copy the matrix.
+        """
+        row = np.asarray(embedding).ravel()
+        embeddings = candidates["embeddings"]
+        size = 0 if embeddings is None else len(embeddings)
+        buffer = candidates.get("buffer")
+        if buffer is None or len(buffer) == size:
+            buffer = np.empty((max(2 * size, 16), row.size), dtype=row.dtype if embeddings is None else embeddings.dtype)
+            buffer[:size] = embeddings
+            candidates["buffer"] = buffer
+        buffer[size] = row
+        candidates["embeddings"] = buffer[:size + 1]
+        candidates["msg_ids"].append(msg_id)
+        candidates["payloads"].append(MessageRecord(role, content))
+        candidates["timestamps"].append(timestamp or datetime.now())
+
+    def thread_size(self, thread_id):
+        cur = self.db.conn_for_thread(thread_id).cursor()
+        cur.execute("SELECT COUNT(*) FROM messages WHERE thread_id = ?", (thread_id,))
+        return cur.fetchone()[0]
+
+    def uses_prefilter(self, thread_id):
+        """Whether retrieval on this thread goes through the lexical pre-filter"""
+        return self.db.fts_enabled and self.thread_size(thread_id) > LEXICAL_PREFILTER_THRESHOLD
+
+    def load_candidates(self, thread_id, exclude_latest=True):
+        """Load every embedded message of a thread, oldest first"""
+        cur = self.db.conn_for_thread(thread_id).cursor()
+        cur.execute("""
+            SELECT msg_id, embedding, role, content, timestamp 
+            FROM messages 
+            WHERE thread_id = ? 
+            ORDER BY timestamp ASC
+        """, (thread_id,))
+        records = cur.fetchall()
+        if exclude_latest:
+            records = records[:-1]  # ✅ Exclude last message (the current query)
+        return self._build_candidates(records)
+
+    def load_prefiltered_candidates(self, thread_id, query, exclude_latest=True):
+        """
+        Lexical pre-filter for very large threads: BM25 hits plus recent
+        messages form the candidate set. Returns (candidates, lexical scores).
+        """
+        cur = self.db.conn_for_thread(thread_id).cursor()
+        cur.execute(
+            "SELECT msg_id FROM messages WHERE thread_id = ? ORDER BY timestamp DESC LIMIT ?",
+            (thread_id, LEXICAL_PREFILTER_RECENT + 1)
+        )
+        recent_ids = [row[0] for row in cur.fetchall()]
+        if exclude_latest:
+            current_id, recent_ids = recent_ids[0], recent_ids[1:]  # the current query
+        else:
+            current_id, recent_ids = None, recent_ids[:LEXICAL_PREFILTER_RECENT]
+        lexical = self.db.lexical_search(thread_id, query, limit=LEXICAL_PREFILTER_LIMIT, exclude_msg_id=current_id)
+        candidate_ids = list(set(lexical) | set(recent_ids))
+        placeholders = ",".join("?" * len(candidate_ids))
+        cur.execute(f"""
+            SELECT msg_id, embedding, role, content, timestamp 
+            FROM messages 
+            WHERE thread_id = ? AND msg_id IN ({placeholders})
+            ORDER BY timestamp ASC
+        """, (thread_id, *candidate_ids))
+        return self._build_candidates(cur.fetchall()), lexical
+
+    def get_hybrid_matches_with_token_limit(self, thread_id, query, top_k=5, max_tokens=2000, semantic_weight=0.7,
+                                            recency_weight=0.3, lexical_weight=LEXICAL_WEIGHT, fusion=FUSION_METHOD,
+                                            diversify=False, mmr_lambda=0.7, dedup_threshold=0.95,
+                                            exclude_latest=True, query_emb=None, candidates=None):
+        """
+        Hybrid retrieval with token limit awareness.
+        Returns up to top_k (role, content) messages that fit within max_tokens budget.
+        See retrieve_with_scores for the scoring details.
+        """
+        result = self.retrieve_with_scores(
+            thread_id, query, top_k=top_k, max_tokens=max_tokens, semantic_weight=semantic_weight,
+            recency_weight=recency_weight, lexical_weight=lexical_weight, fusion=fusion,
+            diversify=diversify, mmr_lambda=mmr_lambda, dedup_threshold=dedup_threshold,
+            exclude_latest=exclude_latest, query_emb=query_emb, candidates=candidates
+        )
+        return [MessageRecord(msg["role"], msg["content"]) for msg in result["messages"]]
+
+    def retrieve_with_scores(self, thread_id, query, top_k=5, max_tokens=2000, semantic_weight=0.7,
+                             recency_weight=0.3, lexical_weight=LEXICAL_WEIGHT, fusion=FUSION_METHOD,
+                             diversify=False, mmr_lambda=0.7, dedup_threshold=0.95,
+                             exclude_latest=True, query_emb=None, candidates=None):
+        """
+        Hybrid retrieval with per-message score breakdown and per-stage timings.
+        Semantic, recency and BM25 (FTS5) scores are fused by weighted sum or
+        reciprocal rank fusion ("rrf"). On threads larger than
+        LEXICAL_PREFILTER_THRESHOLD only BM25 hits plus the most recent
+        messages are loaded and vector-scored.
+        With diversify, the top MMR_CANDIDATES are re-ranked by MMR and
+        near-duplicates are collapsed before filling the token budget.
+        Batch callers can pass a precomputed query_emb and already loaded candidates.
+        """
+        timings = {}
+        started = time.perf_counter()
+        lexical = None
+        if candidates is None:
+            if self.uses_prefilter(thread_id):
+                candidates, lexical = self.load_prefiltered_candidates(thread_id, query, exclude_latest)
+            else:
+                candidates = self.load_candidates(thread_id, exclude_latest)
+        timings["load_ms"] = (time.perf_counter() - started) * 1000
         
-        # Convert to numpy array
-        embeddings = np.array(embeddings)
+        result = {"messages": [], "candidates": len(candidates["msg_ids"]), "token_count": 0, "timings_ms": timings}
+        if candidates["embeddings"] is None:
+            timings["total_ms"] = (time.perf_counter() - started) * 1000
+            return result
+        
+        stage = time.perf_counter()
+        if lexical is None:
+            lexical = self.db.lexical_search(thread_id, query) if lexical_weight else {}
+        timings["lexical_ms"] = (time.perf_counter() - stage) * 1000
+        
+        msg_ids = candidates["msg_ids"]
+        embeddings = candidates["embeddings"]
+        payloads = candidates["payloads"]
+        timestamps = candidates["timestamps"]
         
         # Semantic similarity score
-        query_emb = self.model.encode(query)
+        stage = time.perf_counter()
+        if query_emb is None:
+            query_emb = self.encode_query(query)
+        timings["encode_ms"] = (time.perf_counter() - stage) * 1000
+        
+        stage = time.perf_counter()
         semantic_scores = np.dot(embeddings, query_emb)
         
         # Normalize semantic scores
@@ -183,33 +451,70 @@ class MemoryManager:
             semantic_scores = np.array([1.0])
         
         # Recency score
-        now = datetime.datetime.now()
+        now = datetime.now()
         recency_scores = np.array([
             1.0 / (1.0 + (now - ts).total_seconds() / 3600) 
             for ts in timestamps
         ])
         
+        # Lexical (BM25) score, normalized over the candidates; 0 = no term match
+        lexical_scores = np.array([lexical.get(msg_id, 0.0) for msg_id in msg_ids])
+        if lexical_scores.max() > 0:
+            lexical_scores = lexical_scores / lexical_scores.max()
+        
         # Hybrid score
-        hybrid_scores = (semantic_weight * semantic_scores) + (recency_weight * recency_scores)
+        if fusion == "rrf":
+            hybrid_scores = reciprocal_rank_fusion([
+                (semantic_scores, semantic_weight, False),
+                (recency_scores, recency_weight, False),
+                (lexical_scores, lexical_weight, True)
+            ])
+        else:
+            hybrid_scores = (semantic_weight * semantic_scores) + (recency_weight * recency_scores) + (lexical_weight * lexical_scores)
+        
+        timings["score_ms"] = (time.perf_counter() - stage) * 1000
         
         # Sort by hybrid score (descending)
+        stage = time.perf_counter()
         sorted_indices = np.argsort(hybrid_scores)[::-1]
+        if diversify:
+            pool = sorted_indices[:MMR_CANDIDATES]
+            sorted_indices = (
+                pool[i] for i in mmr_order(embeddings[pool], hybrid_scores[pool], mmr_lambda, dedup_threshold)
+            )
         
-        # Select messages within token budget
+        # Select up to top_k messages within token budget
         selected_messages = []
         token_count = self.count_tokens(query)
         
         for idx in sorted_indices:
+            if top_k is not None and len(selected_messages) >= top_k:
+                break
             msg_role, msg_content = payloads[idx]
             msg_tokens = self.count_tokens(f"{msg_role}: {msg_content}\n")
             
             if token_count + msg_tokens <= max_tokens:
-                selected_messages.append((msg_role, msg_content))
+                selected_messages.append({
+                    "msg_id": msg_ids[idx],
+                    "role": msg_role,
+                    "content": msg_content,
+                    "timestamp": timestamps[idx].isoformat(),
+                    "tokens": msg_tokens,
+                    "semantic_score": float(semantic_scores[idx]),
+                    "recency_score": float(recency_scores[idx]),
+                    "lexical_score": float(lexical_scores[idx]),
+                    "final_score": float(hybrid_scores[idx])
+                })
                 token_count += msg_tokens
             else:
                 break
+        timings["select_ms"] = (time.perf_counter() - stage) * 1000
+        timings["total_ms"] = (time.perf_counter() - started) * 1000
         
-        return selected_messages
+        result["messages"] = selected_messages
+        result["token_count"] = token_count
+        return result
+
 
 
 def get_relevant_history(current_prompt, thread_history):
@@ -261,38 +566,53 @@ class RetrievalLogger:
         except Exception as e:
             print(f"Error writing to log: {e}")
     
-    def get_stats(self):
-        """Retrieve and analyze logs"""
+    def get_stats(self, include_logs=True):
+        """
+        Retrieve and analyze logs in one streaming pass.
+        Returns (stats, logs); logs is None unless include_logs, and stats is
+        None when nothing has been logged yet.
+        """
         if not os.path.exists(self.log_file):
-            return None
+            return None, []
         
-        logs = []
+        logs = [] if include_logs else None
+        total = 0
+        retrieved_sum = 0
+        token_sum = 0
+        response_sum = 0
+        threads = set()
+        methods = {}
         with open(self.log_file, 'r') as f:
             for line in f:
                 try:
-                    logs.append(json.loads(line))
+                    log = json.loads(line)
                 except:
-                    pass
+                    continue
+                total += 1
+                retrieved_sum += log["retrieved_messages"]
+                token_sum += log["token_count"]
+                response_sum += log["response_length"]
+                threads.add(log["thread_id"])
+                # Count retrieval methods
+                method = log.get("retrieval_method", "unknown")
+                methods[method] = methods.get(method, 0) + 1
+                if include_logs:
+                    logs.append(log)
         
-        if not logs:
-            return None
+        if not total:
+            return None, logs
         
         # Calculate stats
         stats = {
-            "total_retrievals": len(logs),
-            "avg_retrieved_messages": sum(l["retrieved_messages"] for l in logs) / len(logs),
-            "avg_token_count": sum(l["token_count"] for l in logs) / len(logs),
-            "avg_response_length": sum(l["response_length"] for l in logs) / len(logs),
-            "total_tokens_used": sum(l["token_count"] for l in logs),
-            "threads_accessed": len(set(l["thread_id"] for l in logs)),
-            "retrieval_methods": {}
+            "total_retrievals": total,
+            "avg_retrieved_messages": retrieved_sum / total,
+            "avg_token_count": token_sum / total,
+            "avg_response_length": response_sum / total,
+            "total_tokens_used": token_sum,
+            "threads_accessed": len(threads),
+            "retrieval_methods": methods
         }
         
-        # Count retrieval methods
-        for log in logs:
-            method = log.get("retrieval_method", "unknown")
-            stats["retrieval_methods"][method] = stats["retrieval_methods"].get(method, 0) + 1
-        
         return stats, logs
 
 
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import random
+import threading
+import functools
+import cProfile
+import pstats
+import io
+import tracemalloc
+from collections import Counter
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "stack")  # stack | cprofile
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "5000"))
+
+def collapse(frame):
+    """Frame -> 'file:func;file:func' (root first), the format flamegraph.pl reads"""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+class StackSampler:
+    """Samples one thread's stack every interval until stopped"""
+
+    def __init__(self, thread_id, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def __enter__(self):
+        self.worker.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.worker.join()
+
+class Profiler:
+    """
+    Samples a fraction of requests per endpoint. When sample_rate is 0 the
+    wrapped handler is called directly, so there is no cost when off.
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, mode=PROFILE_MODE):
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.stacks = {}    # endpoint -> Counter of collapsed stacks
+        self.cprofile = {}  # endpoint -> pstats.Stats
+        self.sampled = Counter()
+
+    def configure(self, sample_rate=None, mode=None):
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError("sample_rate must be between 0 and 1")
+            self.sample_rate = sample_rate
+        if mode is not None:
+            if mode not in ("stack", "cprofile"):
+                raise ValueError("mode must be 'stack' or 'cprofile'")
+            self.mode = mode
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.cprofile.clear()
+            self.sampled.clear()
+
+    def profile(self, endpoint):
+        """Decorator for sync handlers; runs in the worker thread that serves the request"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.sample_rate or random.random() >= self.sample_rate:
+                    return fn(*args, **kwargs)
+                if self.mode == "cprofile":
+                    return self._run_cprofile(endpoint, fn, args, kwargs)
+                return self._run_sampled(endpoint, fn, args, kwargs)
+            return wrapper
+        return decorator
+
+    def _run_sampled(self, endpoint, fn, args, kwargs):
+        sampler = StackSampler(threading.get_ident())
+        try:
+            with sampler:
+                return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                counter = self.stacks.setdefault(endpoint, Counter())
+                counter.update(sampler.stacks)
+                if len(counter) > PROFILE_MAX_STACKS:
+                    self.stacks[endpoint] = Counter(dict(counter.most_common(PROFILE_MAX_STACKS)))
+                self.sampled[endpoint] += 1
+
+    def _run_cprofile(self, endpoint, fn, args, kwargs):
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(fn, *args, **kwargs)
+        finally:
+            with self.lock:
+                if endpoint in self.cprofile:
+                    self.cprofile[endpoint].add(prof)
+                else:
+                    self.cprofile[endpoint] = pstats.Stats(prof)
+                self.sampled[endpoint] += 1
+
+    def collapsed(self, endpoint):
+        """Collapsed-stack text for an endpoint (one 'stack count' per line)"""
+        with self.lock:
+            counter = Counter(self.stacks.get(endpoint, {}))
+        return "\n".join(f"{stack} {count}" for stack, count in counter.most_common())
+
+    def cprofile_report(self, endpoint, limit=50):
+        with self.lock:
+            stats = self.cprofile.get(endpoint)
+            if stats is None:
+                return ""
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, endpoint):
+        """Write the endpoint's collapsed stacks under PROFILE_DIR; returns the path"""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{endpoint.strip('/').replace('/', '_') or 'root'}-{int(time.time())}.collapsed")
+        with open(path, "w") as f:
+            f.write(self.collapsed(endpoint) + "\n")
+        return path
+
+    def status(self):
+        with self.lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "mode": self.mode,
+                "sampled_requests": dict(self.sampled),
+                "endpoints": sorted(set(self.stacks) | set(self.cprofile)),
+                "tracemalloc": tracemalloc.is_tracing()
+            }
+
+    def heap_snapshot(self, limit=20, stop=False):
+        """
+        Start tracemalloc on the first call; afterwards write a snapshot under
+        PROFILE_DIR and return the top allocation sites.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            return {"status": "tracing started", "top": []}
+        snapshot = tracemalloc.take_snapshot()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"heap-{int(time.time())}.snapshot")
+        snapshot.dump(path)
+        top = [
+            {"location": str(stat.traceback), "size_bytes": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:limit]
+        ]
+        if stop:
+            tracemalloc.stop()
+        return {"status": "snapshot written", "file": path, "top": top}
+
+profiler = Profiler()
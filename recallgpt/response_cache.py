@@ -0,0 +1,127 @@
+import sqlite3
+import hashlib
+import json
+import threading
+import time
+
+class ResponseCache:
+    """SQLite-backed cache of LLM responses with TTL/size eviction and in-flight deduplication"""
+
+    def __init__(self, db_file='llm_cache.db', ttl_seconds=3600, max_entries=1000):
+        self.db_file = db_file
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.inflight = {}  # key -> {"event": Event, "result": str, "error": Exception}
+        self.inflight_lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "deduplicated": 0}
+        self.setup_db()
+
+    @property
+    def conn(self):
+        """Get thread-local database connection"""
+        if not hasattr(self.local, 'connection') or self.local.connection is None:
+            self.local.connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        return self.local.connection
+
+    def setup_db(self):
+        cur = self.conn.cursor()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                cache_key TEXT PRIMARY KEY,
+                response TEXT,
+                created_at REAL,
+                last_access REAL
+            )
+        ''')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model, options, prompt):
+        """Key on (model, options, prompt hash)"""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        raw = json.dumps([model, options or {}, prompt_hash], sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        cur = self.conn.cursor()
+        cur.execute("SELECT response, created_at FROM responses WHERE cache_key = ?", (key,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        response, created_at = row
+        now = time.time()
+        if now - created_at > self.ttl_seconds:
+            cur.execute("DELETE FROM responses WHERE cache_key = ?", (key,))
+            self.conn.commit()
+            return None
+        cur.execute("UPDATE responses SET last_access = ? WHERE cache_key = ?", (now, key))
+        self.conn.commit()
+        return response
+
+    def put(self, key, response):
+        now = time.time()
+        cur = self.conn.cursor()
+        cur.execute(
+            "INSERT OR REPLACE INTO responses (cache_key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, response, now, now)
+        )
+        self.evict(now)
+        self.conn.commit()
+
+    def evict(self, now=None):
+        """Drop expired entries, then least recently used ones beyond max_entries"""
+        now = now or time.time()
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        cur.execute('''
+            DELETE FROM responses WHERE cache_key IN (
+                SELECT cache_key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached response for key, or run compute() once.
+        Concurrent callers with the same key wait on the in-flight generation.
+        """
+        cached = self.get(key)
+        with self.inflight_lock:
+            if cached is not None:
+                self.stats["hits"] += 1
+                return cached
+            waiter = self.inflight.get(key)
+            if waiter is None:
+                waiter = {"event": threading.Event(), "result": None, "error": None}
+                self.inflight[key] = waiter
+                owner = True
+            else:
+                owner = False
+            self.stats["misses" if owner else "deduplicated"] += 1
+
+        if not owner:
+            waiter["event"].wait()
+            if waiter["error"] is not None:
+                raise waiter["error"]
+            return waiter["result"]
+
+        try:
+            result = compute()
+            waiter["result"] = result
+            if result:
+                self.put(key, result)
+            return result
+        except Exception as e:
+            waiter["error"] = e
+            raise
+        finally:
+            with self.inflight_lock:
+                self.inflight.pop(key, None)
+            waiter["event"].set()
+
+    def get_stats(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM responses")
+        stats = dict(self.stats)
+        stats["entries"] = cur.fetchone()[0]
+        return stats
@@ -0,0 +1,196 @@
+import os
+import datetime
+import threading
+from typing import Optional
+from pydantic import BaseModel
+
+RETENTION_EMBEDDING_MAX_AGE_DAYS = os.getenv("RETENTION_EMBEDDING_MAX_AGE_DAYS")
+RETENTION_ARCHIVE_AFTER_DAYS = os.getenv("RETENTION_ARCHIVE_AFTER_DAYS")
+RETENTION_MAX_MESSAGES = os.getenv("RETENTION_MAX_MESSAGES")
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "0"))
+RETENTION_VACUUM_MODE = os.getenv("RETENTION_VACUUM_MODE", "incremental")  # incremental | full | off
+
+def _optional_int(value):
+    return int(value) if value not in (None, "") else None
+
+class RetentionPolicy(BaseModel):
+    """Retention limits; None means keep forever"""
+    embedding_max_age_days: Optional[int] = None
+    archive_after_days: Optional[int] = None
+    max_messages: Optional[int] = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            embedding_max_age_days=_optional_int(RETENTION_EMBEDDING_MAX_AGE_DAYS),
+            archive_after_days=_optional_int(RETENTION_ARCHIVE_AFTER_DAYS),
+            max_messages=_optional_int(RETENTION_MAX_MESSAGES)
+        )
+
+    def merged_over(self, base):
+        """Fields set on this policy override base"""
+        fields = base.model_dump()
+        fields.update({k: v for k, v in self.model_dump().items() if v is not None})
+        return RetentionPolicy(**fields)
+
+class RetentionManager:
+    """
+    Applies per-thread / per-user retention policies shard by shard:
+    drops old embeddings, archives cold threads and messages over the
+    per-thread cap, then vacuums and reports reclaimed space.
+    """
+
+    def __init__(self, db, default_policy=None, vacuum_mode=RETENTION_VACUUM_MODE):
+        self.db = db
+        self.default_policy = default_policy or RetentionPolicy.from_env()
+        self.vacuum_mode = vacuum_mode
+        self.stop_event = threading.Event()
+        self.worker = None
+        self.last_report = None
+
+    def set_policy(self, scope, scope_id, policy):
+        """Store a policy for scope 'thread' or 'user'"""
+        if scope not in ("thread", "user"):
+            raise ValueError("scope must be 'thread' or 'user'")
+        cur = self.db.conn.cursor()
+        cur.execute(
+            '''INSERT OR REPLACE INTO retention_policies
+               (scope, scope_id, embedding_max_age_days, archive_after_days, max_messages)
+               VALUES (?, ?, ?, ?, ?)''',
+            (scope, str(scope_id), policy.embedding_max_age_days, policy.archive_after_days, policy.max_messages)
+        )
+        self.db.conn.commit()
+
+    def load_policies(self):
+        cur = self.db.conn.cursor()
+        cur.execute(
+            "SELECT scope, scope_id, embedding_max_age_days, archive_after_days, max_messages FROM retention_policies"
+        )
+        policies = {}
+        for scope, scope_id, emb_days, archive_days, max_messages in cur.fetchall():
+            policies[(scope, scope_id)] = RetentionPolicy(
+                embedding_max_age_days=emb_days,
+                archive_after_days=archive_days,
+                max_messages=max_messages
+            )
+        return policies
+
+    def resolve(self, policies, thread_id, user_id):
+        """Thread policy beats user policy beats the default"""
+        policy = self.default_policy
+        if user_id is not None and ("user", str(user_id)) in policies:
+            policy = policies[("user", str(user_id))].merged_over(policy)
+        if ("thread", str(thread_id)) in policies:
+            policy = policies[("thread", str(thread_id))].merged_over(policy)
+        return policy
+
+    def apply_to_thread(self, conn, thread_id, policy, last_ts, count, now, report):
+        if policy.archive_after_days is not None and last_ts:
+            if datetime.datetime.fromisoformat(last_ts) < now - datetime.timedelta(days=policy.archive_after_days):
+                # Only what the snapshot saw: a message written since means the thread just became active
+                msg_ids = [r[0] for r in conn.execute(
+                    "SELECT msg_id FROM messages WHERE thread_id=? AND timestamp <= ?", (thread_id, last_ts)
+                )]
+                newer = conn.execute(
+                    "SELECT 1 FROM messages WHERE thread_id=? AND timestamp > ? LIMIT 1", (thread_id, last_ts)
+                ).fetchone()
+                if newer is None:
+                    report["archived_messages"] += self.db.archive_messages(thread_id, msg_ids, "cold")
+                    report["archived_threads"] += 1
+                return
+
+        if policy.max_messages is not None and count > policy.max_messages:
+            msg_ids = [r[0] for r in conn.execute(
+                "SELECT msg_id FROM messages WHERE thread_id=? ORDER BY msg_id LIMIT ?",
+                (thread_id, count - policy.max_messages)
+            )]
+            report["archived_messages"] += self.db.archive_messages(thread_id, msg_ids, "cap")
+
+        if policy.embedding_max_age_days is not None:
+            cutoff = (now - datetime.timedelta(days=policy.embedding_max_age_days)).isoformat()
+            dropped = [r[0] for r in conn.execute(
+                "SELECT embedding FROM messages WHERE thread_id=? AND timestamp < ? AND embedding IS NOT NULL",
+                (thread_id, cutoff)
+            )]
+            cur = conn.execute(
+                "UPDATE messages SET embedding=NULL WHERE thread_id=? AND timestamp < ? AND embedding IS NOT NULL",
+                (thread_id, cutoff)
+            )
+            report["embeddings_dropped"] += cur.rowcount
+            conn.commit()
+            # Messages without an embedding no longer count towards the thread centroid
+            self.db.update_centroid_blobs(thread_id, dropped, weight=-1)
+
+    def vacuum(self, conn):
+        if self.vacuum_mode == "full":
+            conn.execute("VACUUM")
+        elif self.vacuum_mode == "incremental":
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Switching to incremental mode only takes effect after one full VACUUM
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                # execute() steps the pragma once, which frees a single page; executescript runs it to the end
+                conn.executescript("PRAGMA incremental_vacuum;")
+            conn.commit()
+
+    def run_once(self):
+        """Apply policies on every shard and compact; returns a report"""
+        now = datetime.datetime.now()
+        policies = self.load_policies()
+        report = {
+            "started_at": now.isoformat(),
+            "archived_threads": 0,
+            "archived_messages": 0,
+            "embeddings_dropped": 0,
+            "bytes_before": 0,
+            "bytes_after": 0,
+            "errors": [],
+            "notes": []
+        }
+
+        for shard in range(self.db.num_shards):
+            path = self.db.shard_files[shard]
+            conn = self.db.shard_conn(shard)
+            report["bytes_before"] += os.path.getsize(path) if os.path.exists(path) else 0
+            dropped_before = report["embeddings_dropped"]
+            try:
+                threads = conn.execute(
+                    "SELECT thread_id, MAX(timestamp), COUNT(*), MAX(user_id) FROM messages GROUP BY thread_id"
+                ).fetchall()
+                for thread_id, last_ts, count, user_id in threads:
+                    policy = self.resolve(policies, thread_id, user_id)
+                    self.apply_to_thread(conn, thread_id, policy, last_ts, count, now, report)
+                self.vacuum(conn)
+                if report["embeddings_dropped"] > dropped_before and self.vacuum_mode != "full":
+                    report["notes"].append(
+                        f"shard {shard}: dropped embeddings only shrink rows inside their pages and free none; "
+                        "run with RETENTION_VACUUM_MODE=full to return that space"
+                    )
+            except Exception as e:
+                report["errors"].append(f"shard {shard}: {e}")
+            report["bytes_after"] += os.path.getsize(path) if os.path.exists(path) else 0
+
+        report["reclaimed_bytes"] = report["bytes_before"] - report["bytes_after"]
+        report["finished_at"] = datetime.datetime.now().isoformat()
+        self.last_report = report
+        return report
+
+    def start(self, interval_seconds=RETENTION_INTERVAL_SECONDS):
+        """Run compaction in the background every interval_seconds (0 disables)"""
+        if interval_seconds <= 0 or self.worker is not None:
+            return
+
+        def loop():
+            while not self.stop_event.wait(interval_seconds):
+                try:
+                    report = self.run_once()
+                    print(f"Retention run reclaimed {report['reclaimed_bytes']} bytes")
+                except Exception as e:
+                    print(f"Retention run failed: {e}")
+
+        self.worker = threading.Thread(target=loop, daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,142 @@
+"""
+Split or rebalance message storage across SQLite shards.
+
+    python shard_tool.py --db recallgpt.db --from-shards 1 --to-shards 4
+    python shard_tool.py --db recallgpt.db --from-shards 4 --to-shards 8 --dry-run
+
+Threads are assigned greedily (largest first, to the least loaded shard).
+Each moved thread replaces any copy already on the target and is committed
+there in one transaction, then deleted from the source. An interrupted run
+never loses messages. Re-running it overwrites the partial copy, and any
+duplicate left in a third file is reported and dropped.
+"""
+import argparse
+import os
+import sqlite3
+from db_manager import shard_files_for, MESSAGES_SCHEMA, MESSAGES_INDEX, ARCHIVE_SCHEMA, DB_SHARD_DIR
+
+def thread_sizes(files):
+    """
+    thread_id -> (source file, message count) across the current layout, plus
+    thread_id -> [other files] for threads found in more than one file.
+    A move commits the target copy atomically before the source is deleted,
+    so duplicate copies are complete and any one of them can be kept.
+    """
+    sizes = {}
+    duplicates = {}
+    for path in files:
+        conn = sqlite3.connect(path)
+        conn.execute(MESSAGES_SCHEMA)
+        conn.execute(ARCHIVE_SCHEMA)
+        for thread_id, count in conn.execute(
+            '''SELECT thread_id, SUM(n) FROM (
+                   SELECT thread_id, COUNT(*) AS n FROM messages GROUP BY thread_id
+                   UNION ALL
+                   SELECT thread_id, SUM(msg_count) AS n FROM archived_messages GROUP BY thread_id
+               ) GROUP BY thread_id'''
+        ):
+            if thread_id in sizes:
+                duplicates.setdefault(thread_id, []).append(path)
+            else:
+                sizes[thread_id] = (path, count)
+        conn.close()
+    return sizes, duplicates
+
+def plan_assignment(sizes, num_shards):
+    """Greedy balance by message count"""
+    loads = [0] * num_shards
+    assignment = {}
+    for thread_id, (_, count) in sorted(sizes.items(), key=lambda item: item[1][1], reverse=True):
+        shard = loads.index(min(loads))
+        assignment[thread_id] = shard
+        loads[shard] += count
+    return assignment, loads
+
+def drop_thread(path, thread_id):
+    """Delete a thread's live and archived rows from one file"""
+    conn = sqlite3.connect(path)
+    conn.execute("DELETE FROM messages WHERE thread_id=?", (thread_id,))
+    conn.execute("DELETE FROM archived_messages WHERE thread_id=?", (thread_id,))
+    conn.commit()
+    conn.close()
+
+def move_thread(thread_id, source, target):
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    dst.execute(MESSAGES_SCHEMA)
+    dst.execute(MESSAGES_INDEX)
+    dst.execute(ARCHIVE_SCHEMA)
+    # Replace a copy left by an interrupted run in the same transaction as the insert
+    dst.execute("DELETE FROM messages WHERE thread_id=?", (thread_id,))
+    dst.execute("DELETE FROM archived_messages WHERE thread_id=?", (thread_id,))
+    rows = src.execute(
+        '''SELECT thread_id, role, content, embedding, user_id, timestamp
+           FROM messages WHERE thread_id=? ORDER BY msg_id''',
+        (thread_id,)
+    ).fetchall()
+    # msg_id is per-shard, so let the target assign new ids (insertion order is preserved)
+    dst.executemany(
+        "INSERT INTO messages (thread_id, role, content, embedding, user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    archived = src.execute(
+        '''SELECT thread_id, reason, msg_count, payload, archived_at
+           FROM archived_messages WHERE thread_id=? ORDER BY archive_id''',
+        (thread_id,)
+    ).fetchall()
+    dst.executemany(
+        "INSERT INTO archived_messages (thread_id, reason, msg_count, payload, archived_at) VALUES (?, ?, ?, ?, ?)",
+        archived
+    )
+    dst.commit()
+    src.close()
+    dst.close()
+    drop_thread(source, thread_id)
+    return len(rows)
+
+def rebalance(db_file, from_shards, to_shards, shard_dir=DB_SHARD_DIR, dry_run=False):
+    old_files = shard_files_for(db_file, from_shards, shard_dir)
+    new_files = shard_files_for(db_file, to_shards, shard_dir)
+    sizes, duplicates = thread_sizes(old_files)
+    assignment, loads = plan_assignment(sizes, to_shards)
+
+    print(f"{len(sizes)} threads, {sum(c for _, c in sizes.values())} messages")
+    for thread_id, paths in sorted(duplicates.items()):
+        print(f"  thread {thread_id} is in more than one file: {[sizes[thread_id][0]] + paths}; extra copies will be dropped")
+    for shard, load in enumerate(loads):
+        print(f"  shard {shard}: {load} messages -> {new_files[shard]}")
+    if dry_run:
+        return assignment
+
+    for path in new_files:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    catalog = sqlite3.connect(db_file)
+    catalog.execute("CREATE TABLE IF NOT EXISTS thread_shards (thread_id INTEGER PRIMARY KEY, shard INTEGER)")
+    moved = 0
+    for thread_id, shard in assignment.items():
+        source = sizes[thread_id][0]
+        target = new_files[shard]
+        if source != target:
+            moved += move_thread(thread_id, source, target)
+        for path in duplicates.get(thread_id, []):
+            if path != target:
+                drop_thread(path, thread_id)
+        catalog.execute(
+            "INSERT OR REPLACE INTO thread_shards (thread_id, shard) VALUES (?, ?)",
+            (thread_id, shard)
+        )
+        catalog.commit()
+    catalog.close()
+    print(f"Moved {moved} messages. Set DB_SHARDS={to_shards} before restarting the API.")
+    return assignment
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split or rebalance RecallGPT message shards")
+    parser.add_argument("--db", default="recallgpt.db", help="Catalog database file")
+    parser.add_argument("--from-shards", type=int, default=1, help="Current number of shards")
+    parser.add_argument("--to-shards", type=int, required=True, help="Target number of shards")
+    parser.add_argument("--shard-dir", default=DB_SHARD_DIR, help="Directory holding shard files")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the plan")
+    args = parser.parse_args()
+    rebalance(args.db, args.from_shards, args.to_shards, args.shard_dir, args.dry_run)
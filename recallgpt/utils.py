@@ -0,0 +1,24 @@
+import json
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+def dumps(obj):
+    """Serialize to JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(Response):
+    """Serializes content directly, skipping FastAPI's jsonable_encoder pass"""
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
+
+def json_array(encoded_rows):
+    """Join already JSON-encoded rows into a JSON array without decoding them"""
+    return "[" + ",".join(encoded_rows) + "]"